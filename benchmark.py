@@ -0,0 +1,94 @@
+import os
+import random
+import subprocess
+import sys
+import tracemalloc
+
+# modules that must not be loaded by `import identification`
+HEAVY_MODULES = ('numpy', 'networkx', 'matplotlib')
+
+_STARTUP_SCRIPT = '''
+import sys, time
+t = time.perf_counter()
+import identification
+print(time.perf_counter() - t)
+print(','.join(m for m in {heavy!r} if m in sys.modules))
+'''
+
+
+def bench_startup(repeat: int = 5, budget: float = 0.2) -> float:
+    """
+    Cold start of `import identification` in a fresh interpreter (best of repeat, in seconds).
+    Raises AssertionError if a heavy module is imported or the budget is exceeded.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', _STARTUP_SCRIPT.format(heavy=HEAVY_MODULES)],
+                             capture_output=True, text=True, check=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__))).stdout.splitlines()
+        best = min(best, float(out[0]))
+        loaded = out[1] if len(out) > 1 else ''
+        assert not loaded, f'import identification loaded heavy modules: {loaded}'
+    assert best <= budget, f'import identification took {best:.3f}s (budget {budget:.3f}s)'
+    return best
+
+
+def random_diagram(n: int, degree: float = 2.0, confounding: float = 1.0, seed: int = 0):
+    """ random causal diagram with about degree * n directed and confounding * n bidirected edges """
+    from model import CD
+
+    rng = random.Random(seed)
+    vs = [f'V{i}' for i in range(n)]
+    p_edge, p_bidir = min(1.0, 2 * degree / max(n - 1, 1)), min(1.0, 2 * confounding / max(n - 1, 1))
+    directed = [(vs[i], vs[j]) for i in range(n) for j in range(i + 1, n) if rng.random() < p_edge]
+    bidirected = [(vs[i], vs[j], f'U_{i}_{j}') for i in range(n) for j in range(i + 1, n) if rng.random() < p_bidir]
+    return CD(vs, directed, bidirected)
+
+
+def _allocated(build):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before, kept
+
+
+def bench_memory(sizes=(10, 50, 200, 2000), n_derived: int = 200, small: int = 5, seed: int = 0) -> dict:
+    """
+    Bytes per CausalDiagram (root, and derived with induced/do) and per Probability node.
+    'small' is G[S] with |S| = small, whose cost must not grow with the root.
+    Expression nodes are measured on the line 6 product  prod_v P(v | preceding(v)).
+    """
+    import model
+    from probability import Probability
+
+    report = dict()
+    for n in sizes:
+        rng = random.Random(seed)
+        model.DIAGRAM_CACHE.clear()
+        root_bytes, G = _allocated(lambda: random_diagram(n, seed=seed))
+        order = G.causal_order()
+        subsets = [set(rng.sample(order, rng.randint(1, n))) for _ in range(n_derived)]
+        derived_bytes, derived = _allocated(lambda: [G[S].do(set(rng.sample(sorted(S), 1))) for S in subsets])
+        model.DIAGRAM_CACHE.clear()
+        small_subsets = [set(rng.sample(order, min(small, n))) for _ in range(n_derived)]
+        small_bytes, _ = _allocated(lambda: [G[S] for S in small_subsets])
+        model.DIAGRAM_CACHE.clear()
+
+        def line6():
+            children = [Probability(var={v}, cond=G.preceding(v)) for v in order]
+            return Probability(recursive=True, children=children, sumset=set(order[:n // 2]))
+
+        node_bytes, _ = _allocated(line6)
+        report[n] = {'root': root_bytes,
+                     'derived': derived_bytes / (2 * len(derived)),
+                     'small': small_bytes / n_derived,
+                     'node': node_bytes / (n + 1)}
+    return report
+
+
+if __name__ == "__main__":
+    print(f"startup: {bench_startup() * 1000:.1f} ms")
+    for n, r in bench_memory().items():
+        print(f"|V|={n:4d}  root: {r['root']:9.0f} B  derived: {r['derived']:8.0f} B/diagram  small: {r['small']:6.0f} B/diagram  expression: {r['node']:6.0f} B/node")
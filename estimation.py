@@ -1,80 +1,342 @@
+'''
+Estimation of identified effects from samples.
+
+The marginals an estimand needs (the var|cond and cond of every P(var|cond) leaf and divisor) are
+collected first and counted once each from integer-coded data, sharing one count cache keyed by
+variable set, then combined by evaluation.Evaluator.
+'''
+from collections import defaultdict
+from itertools import islice
+from math import prod
+from typing import Mapping
+
+import numpy as np
+
+from evaluation import DENSE_LIMIT, DENSITY, SPARSE_MIN, Evaluator, Factor, SparseFactor, _group, adapt
 from probability import Probability
-from typing import Iterable
-
-class Node:
-    def __init__(self):
-        self.__children = []
-    
-    def add_child(self, child: Probability):
-        self.__children += [child]
-
-class ProbNode(Node):
-    def __init__(self, prob: Probability, inverse: bool):
-        super().__init__()
-        self.prob = prob
-        self.inverse = inverse
-
-class SumNode(Node):
-    def __init__(self, sumset):
-        super().__init__()
-        self.sumset = sumset
-
-class ProductNode(Node):
-    def __init__(self):
-        super().__init__()
-        self.__inversed_children = []
-
-    def add_child(self, child: Probability, inverse: bool):
-        if inverse:
-            self.__inversed_children += [child]
-        else:
-            return super().add_child(child)
-    
-
-def build_tree(parent: Node, prob: Probability):
-    if prob._divisor:
-        # 분수인 경우, ProductNode 생성하고(역수로 처리) divisor에 대해 build tree
-        ProductTerm = ProductNode()
-        parent.add_child(ProductTerm)
-        temp = prob.copy()
-        temp._fraction = False
-        temp._divisor = None
-
-        denomNode = ProbNode(prob._divisor, inverse=True)
-        numerNode = ProbNode(temp)
-
-        ProductTerm.add_child(denomNode)
-        ProductTerm.add_child(numerNode)
-
-        build_tree(denomNode, prob._divisor)
-        build_tree(numerNode, temp)
-
-    elif prob._sumset:
-        sigma = SumNode(prob._sumset)
-        if not prob._recursive:
-            temp = prob.copy()
-            temp._sumset = set()
-            sigma.add_child(temp)
-        else:
-            for child in prob._children:
-                sigma.add_child(child)
-                build_tree()
+from utils import random_seeds, seeded
 
-    
-    if prob._recursive:
-        # recursive한 경우, SumNode 또는 ProductNode 처리
+# bootstrap 복제 표본 축의 이름
+REPLICATE = '#replicate'
 
 
+def required_marginals(P: Probability) -> dict:
+    '''do-set -> variable sets whose joint distribution P needs (each distinct subexpression visited once)'''
+    out = defaultdict(set)
+    seen = set()
+    stack = [P]
+    while stack:
+        node = stack.pop()
+        if node in seen:
+            continue
+        seen.add(node)
+        if not node._recursive:
+            if node._var:
+                # do 변수는 축으로 남김 (Evaluator.conditional)
+                out[node._do].add(node._var | node._cond | node._do)
+                if node._cond | node._do:
+                    out[node._do].add(node._cond | node._do)
         else:
-            node = ProductNode()
-        for child in prob["children"]:
-            build_tree(child, node)
-        if parent:
-            parent.children.append(node)
-        return node
-    else:
-        # leaf node인 경우, TermNode 생성
-        term_node = TermNode(prob["var"], prob["cond"], prob["do"])
-        if parent:
-            parent.children.append(term_node)
-        return term_node
+            stack.extend(node._children)
+        if node._fraction:
+            stack.append(node._divisor)
+    return dict(out)
+
+
+class CountSource:
+    '''
+    Marginals from contingency counts cached by variable set.
+    A set contained in an already counted one is summed out of it instead of going over the rows again.
+    '''
+
+    # 모든 table에 남는 축 (bootstrap의 REPLICATE)
+    _kept = frozenset()
+
+    def __init__(self, cards: Mapping[str, int] = None):
+        self._cards = dict(cards or {})
+        self._counts = dict()
+        self.rows = 0
+        self.scans = 0      # 데이터 전체를 읽은 횟수
+
+
+    def __len__(self):
+        return self.rows
+
+
+    @property
+    def cards(self) -> dict:
+        return self._cards
+
+
+    def counts(self, variables) -> Factor:
+        '''number of rows of every assignment of variables'''
+        key = frozenset(variables)
+        if key not in self._counts:
+            supersets = [k for k in self._counts if key < k]
+            if supersets:
+                # 이미 센 더 큰 table에서 sum out
+                table = self._counts[min(supersets, key=lambda k: self._counts[k].values.size)]
+                self._counts[key] = table.sum_to(key | self._kept)
+            else:
+                self._counts[key] = self._count(sorted(key))
+        return self._counts[key]
+
+
+    def _count(self, vs: list) -> Factor:
+        raise KeyError(f'{set(vs)} was not counted')
+
+
+    def widen(self, cards: Mapping[str, int]):
+        '''raises the cardinalities to the given ones (values not seen in the data get count 0)'''
+        grown = {v: c for v, c in cards.items() if c > self.cards.get(v, 0)}
+        if not grown:
+            return
+        self._cards.update(grown)
+        for key, table in self._counts.items():
+            shape = [grown.get(v, n) for v, n in zip(table.vars, table.shape)]
+            if isinstance(table, SparseFactor):
+                self._counts[key] = SparseFactor(table.vars, table.coords, table.values, shape)
+            else:
+                self._counts[key] = Factor(table.vars, np.pad(table.values, [(0, m - n) for n, m in zip(table.shape, shape)]))
+
+
+    def marginal(self, variables) -> Factor:
+        '''empirical P(variables)'''
+        return self.counts(variables).scaled(1 / max(len(self), 1))
+
+
+    def prefetch(self, variable_sets):
+        '''counts every variable set, largest first so that the others are summed out of them'''
+        for vs in sorted(variable_sets, key=lambda vs: (-len(vs), sorted(vs))):
+            self.counts(vs)
+
+
+class SampleSource(CountSource):
+    '''
+    Marginals of integer-coded samples in memory (values 0, ..., card - 1 per variable).
+    data : 2d array (rows x columns) with the column names, or variable -> 1d array
+    '''
+
+    def __init__(self, data, columns=None, cards: Mapping[str, int] = None):
+        super().__init__(cards)
+        if isinstance(data, Mapping):
+            columns, data = list(data), np.column_stack([np.asarray(data[v]) for v in data])
+        data = np.asarray(data)
+        assert data.ndim == 2 and len(columns) == data.shape[1], 'one column name per column'
+        self.data = data
+        self.columns = {v: i for i, v in enumerate(columns)}
+        self.rows = data.shape[0]
+
+
+    @property
+    def cards(self) -> dict:
+        for v, i in self.columns.items():
+            if v not in self._cards:
+                self._cards[v] = int(self.data[:, i].max()) + 1 if len(self) else 1
+        return self._cards
+
+
+    def _count(self, vs: list) -> Factor:
+        self.scans += 1
+        if not vs:
+            return Factor((), np.array(float(len(self))))
+        return _counted(vs, self.data[:, [self.columns[v] for v in vs]], [self.cards[v] for v in vs])
+
+
+class StreamSource(CountSource):
+    '''
+    Counts of every given variable set accumulated in a single pass over chunks of rows, so memory
+    does not grow with the number of rows. Only the maximal sets are counted; the others are summed out.
+    chunks : iterable of 2d integer arrays (rows x columns), e.g. from read_chunks
+    Cardinalities not given are grown as larger values show up.
+    '''
+
+    def __init__(self, chunks, columns, variable_sets, cards: Mapping[str, int] = None):
+        super().__init__(cards)
+        columns = {v: i for i, v in enumerate(columns)}
+        variable_sets = {frozenset(vs) for vs in variable_sets}
+        maximal = [sorted(vs) for vs in variable_sets if vs and not any(vs < other for other in variable_sets)]
+        used = sorted(set().union(*maximal))
+        for v in used:
+            self._cards.setdefault(v, 1)
+        tables = {tuple(vs): None for vs in maximal}
+
+        self.scans = 1
+        for chunk in chunks:
+            chunk = np.asarray(chunk)
+            self.rows += chunk.shape[0]
+            if not chunk.shape[0]:
+                continue
+            # 처음 보는 값이 있으면 table을 늘림
+            highest = chunk[:, [columns[v] for v in used]].max(axis=0)
+            self._cards.update({v: int(h) + 1 for v, h in zip(used, highest) if h >= self._cards[v]})
+            for vs, table in tables.items():
+                counts = _counted(vs, chunk[:, [columns[v] for v in vs]], [self._cards[v] for v in vs])
+                tables[vs] = counts if table is None else _accumulate(table, counts)
+
+        for vs, table in tables.items():
+            self._counts[frozenset(vs)] = adapt(table) if table is not None else Factor(vs, np.zeros([self._cards[v] for v in vs]))
+        self._counts[frozenset()] = Factor((), np.array(float(self.rows)))
+
+
+class BootstrapSource(CountSource):
+    '''
+    Weighted counts of B bootstrap replicates of samples at once: every table gets the replicate axis REPLICATE,
+    so an estimand evaluated on this source gives all B estimates in one pass.
+    Replicates are multinomial resamples of the rows (Poisson(1) row weights with poisson=True) drawn under
+    utils.seeded(seed); a random seed is drawn and kept in self.seed if none is given.
+    '''
+    _kept = frozenset([REPLICATE])
+
+    def __init__(self, data, columns=None, B: int = 200, seed: int = None, poisson: bool = False,
+                 cards: Mapping[str, int] = None):
+        self.samples = data if isinstance(data, SampleSource) else SampleSource(data, columns, cards)
+        super().__init__({REPLICATE: B, **self.samples.cards})
+        n = self.rows = len(self.samples)
+        self.seed = random_seeds() if seed is None else seed
+        with seeded(self.seed):
+            if poisson:
+                self.weights = np.random.poisson(1.0, (B, n))
+            else:
+                self.weights = np.random.multinomial(n, np.full(n, 1 / n), size=B) if n else np.zeros((B, 0), dtype=int)
+
+
+    def _count(self, vs: list) -> Factor:
+        self.scans += 1
+        B = len(self.weights)
+        if not vs:
+            return Factor((REPLICATE,), self.weights.sum(axis=1))
+        dims = [self.cards[v] for v in vs]
+        coords, inverse = _group(self.samples.data[:, [self.samples.columns[v] for v in vs]], dims)
+        # 같은 값을 가지는 행끼리 모아서 모든 복제 표본의 가중치를 한 번에 더함 (B x 값의 종류)
+        order = np.argsort(inverse, kind='stable')
+        starts = np.searchsorted(inverse[order], np.arange(len(coords)))
+        counts = np.add.reduceat(self.weights[:, order], starts, axis=1) if len(coords) else np.zeros((B, 0))
+        coords = np.column_stack([np.repeat(np.arange(B), len(coords)), np.tile(coords, (B, 1))])
+        return adapt(SparseFactor((REPLICATE, *vs), coords, counts.ravel(), (B, *dims)))
+
+
+    def marginal(self, variables) -> Factor:
+        '''P(variables) of every replicate'''
+        return self.counts(variables) / self.counts(())
+
+
+def _counted(vs: list, rows: np.ndarray, dims: list):
+    '''counts of the rows (one column per variable of vs), sparse if the table would be large and mostly empty'''
+    size = prod(dims)
+    if size > DENSE_LIMIT or (size > SPARSE_MIN and len(rows) < DENSITY * size):
+        coords, inverse = _group(rows, dims)
+        return SparseFactor(vs, coords, np.bincount(inverse, minlength=len(coords)), dims)
+    flat = np.ravel_multi_index(rows.T, dims)
+    return Factor(vs, np.bincount(flat, minlength=size).reshape(dims))
+
+
+def _accumulate(table, counts):
+    '''table + counts, where counts may have grown along some axes'''
+    if isinstance(table, Factor) and isinstance(counts, Factor):
+        values = np.pad(table.values, [(0, n - m) for m, n in zip(table.shape, counts.shape)])
+        return Factor(table.vars, values + counts.values)
+    table, counts = table.sparse(), counts.sparse()
+    coords, inverse = _group(np.concatenate([table.coords, counts.coords]), counts.shape)
+    values = np.bincount(inverse, weights=np.concatenate([table.values, counts.values]), minlength=len(coords))
+    return SparseFactor(table.vars, coords, values, counts.shape)
+
+
+def read_chunks(path, columns=None, chunksize: int = 1 << 16, delimiter=','):
+    '''
+    (columns, chunks) of an integer-coded file read chunksize rows at a time:
+    a CSV with a header line, or a 2d .npy (memory mapped, columns must be given)
+    '''
+    if str(path).endswith('.npy'):
+        data = np.load(path, mmap_mode='r')
+        assert columns is not None and len(columns) == data.shape[1], 'one column name per column'
+        return list(columns), (np.asarray(data[i:i + chunksize]) for i in range(0, data.shape[0], chunksize))
+
+    with open(path) as f:
+        header = [c.strip() for c in f.readline().split(delimiter)]
+
+    def chunks():
+        with open(path) as f:
+            f.readline()
+            while lines := list(islice(f, chunksize)):
+                yield np.loadtxt(lines, delimiter=delimiter, dtype=np.int64, ndmin=2)
+
+    return header, chunks()
+
+
+def read_csv(path, delimiter=',', dtype=np.int64):
+    '''integer-coded CSV with a header line -> (data, columns)'''
+    with open(path) as f:
+        columns = [c.strip() for c in f.readline().split(delimiter)]
+    data = np.loadtxt(path, delimiter=delimiter, skiprows=1, dtype=dtype, ndmin=2)
+    return data, columns
+
+
+def estimate(P: Probability, data, columns=None, cards: Mapping[str, int] = None, chunksize: int = 1 << 16) -> Factor:
+    '''
+    Value of the estimand P from samples: data as in SampleSource, a CountSource, or the path of a CSV / .npy
+    file which is streamed in one pass (see read_chunks).
+    Every marginal P needs is counted once from the data.
+    '''
+    needed = set().union(*required_marginals(P).values())
+    source = _source(data, columns, needed, cards, chunksize)
+    source.prefetch(needed)
+    return Evaluator(source)(P)
+
+
+def _source(data, columns, needed, cards, chunksize) -> CountSource:
+    if isinstance(data, CountSource):
+        return data
+    if isinstance(data, str):
+        columns, chunks = read_chunks(data, columns, chunksize)
+        return StreamSource(chunks, columns, needed, cards)
+    return SampleSource(data, columns, cards)
+
+
+def experiment_sources(P: Probability, datasets: Mapping, columns=None, cards: Mapping[str, int] = None,
+                       chunksize: int = 1 << 16) -> dict:
+    '''
+    Count sources for the estimand P of mygID, one per experiment: P_z leaves are counted from datasets[z]
+    and the others from datasets[set()] (the observational data).
+    datasets : experiment z (set of intervened variables) -> data as in estimate, with the columns of z
+    Each dataset is read once (streamed if given as a path) and has its own count cache; cardinalities
+    are made the same across datasets.
+    '''
+    datasets = {frozenset(z): data for z, data in datasets.items()}
+    sources = dict()
+    for do, needed in required_marginals(P).items():
+        if do not in datasets:
+            raise KeyError(f'no dataset for the experiment do({", ".join(sorted(do))})')
+        sources[do] = _source(datasets[do], columns, needed, cards, chunksize)
+        sources[do].prefetch(needed)
+
+    common = dict()
+    for source in sources.values():
+        for v, c in source.cards.items():
+            common[v] = max(common.get(v, 0), c)
+    for source in sources.values():
+        source.widen(common)
+    return sources
+
+
+def estimate_experiments(P: Probability, datasets: Mapping, columns=None, cards: Mapping[str, int] = None,
+                         chunksize: int = 1 << 16) -> Factor:
+    '''Value of the gID estimand P from observational and experimental samples (see experiment_sources).'''
+    return Evaluator(experiment_sources(P, datasets, columns, cards, chunksize))(P)
+
+
+def bootstrap(P: Probability, data, columns=None, B: int = 200, level: float = 0.95, seed: int = None,
+              poisson: bool = False, cards: Mapping[str, int] = None):
+    '''
+    Percentile bootstrap interval of the estimand P from samples (data as in SampleSource).
+    All B replicates are counted in one batched operation per variable set and evaluated together.
+    Returns (estimate, lower, upper): the estimate from the samples themselves, and the interval bounds as
+    arrays with axes estimate.vars.
+    '''
+    source = BootstrapSource(data, columns, B, seed, poisson, cards)
+    point = estimate(P, source.samples)
+    needed = set().union(*required_marginals(P).values())
+    source.prefetch(needed)
+    replicates = Evaluator(source)(P).table(REPLICATE, *point.vars)
+    lower, upper = np.quantile(replicates, [(1 - level) / 2, (1 + level) / 2], axis=0)
+    return point, lower, upper
@@ -0,0 +1,504 @@
+'''
+Numeric evaluation of identified estimands.
+
+An expression from myID / mygID is lowered to numpy over a discrete joint distribution:
+leaves P(var|cond) are ratios of marginals of the joint table, a product of children is contracted
+over its sumset by einsum, one summed variable at a time in the order chosen by plan(), and divisors
+are elementwise divisions where 0/0 = 0.
+Tables with few nonzero entries (high-cardinality variables) are kept as SparseFactor instead, switching
+automatically by density.
+'''
+from math import prod
+from typing import Iterable, Mapping
+
+import numpy as np
+
+from probability import Probability
+
+# 0이 아닌 entry의 비율이 DENSITY보다 작고 크기가 SPARSE_MIN보다 크면 sparse로 저장
+DENSITY = 0.05
+SPARSE_MIN = 1 << 12
+# 이보다 큰 table은 dense로 만들지 않음
+DENSE_LIMIT = 1 << 24
+
+
+class Factor:
+    '''Table over discrete variables: values has one axis per variable of vars.'''
+    __slots__ = ('vars', 'values')
+
+    def __init__(self, vars: Iterable[str], values):
+        self.vars = tuple(vars)
+        self.values = np.asarray(values, dtype=float)
+        assert self.values.ndim == len(self.vars), 'one axis per variable'
+
+
+    def __repr__(self):
+        return f"Factor({', '.join(self.vars)}; shape={self.values.shape})"
+
+
+    @property
+    def cards(self) -> dict:
+        return dict(zip(self.vars, self.values.shape))
+
+
+    def table(self, *variables: str) -> np.ndarray:
+        '''values with axes in the given order (variables the factor does not depend on get a broadcast axis)'''
+        variables = variables or self.vars
+        assert set(self.vars) <= set(variables), 'table must keep every variable of the factor'
+        shape = dict(zip(self.vars, self.values.shape))
+        values = self.values.transpose([self.vars.index(v) for v in variables if v in shape])
+        return values.reshape([shape.get(v, 1) for v in variables])
+
+
+    @property
+    def shape(self) -> tuple:
+        return self.values.shape
+
+
+    def sum_to(self, variables) -> 'Factor':
+        '''marginal over the variables of the factor in variables'''
+        axes = tuple(i for i, v in enumerate(self.vars) if v not in variables)
+        return Factor([v for v in self.vars if v in variables], self.values.sum(axis=axes))
+
+
+    def scaled(self, c: float) -> 'Factor':
+        return Factor(self.vars, self.values * c)
+
+
+    def sparse(self) -> 'SparseFactor':
+        if not self.vars:
+            # 상수: 변수가 없는 entry 하나 (0이면 entry 없음)
+            return SparseFactor((), np.zeros((1, 0), dtype=np.int64), self.values.reshape(1), ())
+        nonzero = np.nonzero(self.values)
+        return SparseFactor(self.vars, np.stack(nonzero, axis=1), self.values[nonzero], self.shape)
+
+
+    def __truediv__(self, other: 'Factor') -> 'Factor':
+        if isinstance(other, SparseFactor):
+            return self.sparse() / other
+        # 0/0 = 0 : 확률 0인 사건에 대한 조건부 확률은 0으로 둠
+        out = self.vars + tuple(v for v in other.vars if v not in self.vars)
+        numer, denom = np.broadcast_arrays(self.table(*out), other.table(*out))
+        values = np.zeros(numer.shape)
+        np.divide(numer, denom, out=values, where=denom != 0)
+        return Factor(out, values)
+
+
+class SparseFactor:
+    '''
+    Table over discrete variables stored as its nonzero entries:
+    coords (nnz x len(vars), one row per entry without duplicates), values (nnz) and the full shape.
+    '''
+    __slots__ = ('vars', 'coords', 'values', 'shape')
+
+    def __init__(self, vars: Iterable[str], coords, values, shape):
+        self.vars = tuple(vars)
+        values = np.asarray(values, dtype=float)
+        nonzero = values != 0
+        self.coords = np.asarray(coords, dtype=np.int64).reshape(len(values), len(self.vars))[nonzero]
+        self.values = values[nonzero]
+        self.shape = tuple(shape)
+
+
+    def __repr__(self):
+        return f"SparseFactor({', '.join(self.vars)}; shape={self.shape}, nnz={len(self.values)})"
+
+
+    @property
+    def cards(self) -> dict:
+        return dict(zip(self.vars, self.shape))
+
+
+    def dense(self) -> Factor:
+        if not self.vars:
+            return Factor((), self.values.sum())
+        values = np.zeros(self.shape)
+        values[tuple(self.coords.T)] = self.values
+        return Factor(self.vars, values)
+
+
+    def table(self, *variables: str) -> np.ndarray:
+        return self.dense().table(*variables)
+
+
+    def sum_to(self, variables) -> 'Factor | SparseFactor':
+        keep = [i for i, v in enumerate(self.vars) if v in variables]
+        if not keep:
+            return Factor((), self.values.sum())
+        shape = [self.shape[i] for i in keep]
+        coords, inverse = _group(self.coords[:, keep], shape)
+        return adapt(SparseFactor([self.vars[i] for i in keep], coords,
+                                  np.bincount(inverse, weights=self.values, minlength=len(coords)), shape))
+
+
+    def scaled(self, c: float) -> 'SparseFactor':
+        return SparseFactor(self.vars, self.coords, self.values * c, self.shape)
+
+
+    def sparse(self) -> 'SparseFactor':
+        return self
+
+
+    def __mul__(self, other: 'SparseFactor') -> 'SparseFactor':
+        vars, coords, shape, i, j = _join(self, other.sparse())
+        return SparseFactor(vars, coords, self.values[i] * other.values[j], shape)
+
+
+    def __truediv__(self, other) -> 'SparseFactor':
+        # 분모가 0인 entry는 저장되어 있지 않으므로 0/0 = 0
+        other = other.sparse()
+        vars, coords, shape, i, j = _join(self, other)
+        return adapt(SparseFactor(vars, coords, self.values[i] / other.values[j], shape))
+
+
+def _group(coords: np.ndarray, shape) -> tuple:
+    '''distinct rows of coords and the index of each row among them'''
+    if not len(shape):
+        # 변수가 없으면 모든 row가 한 group
+        return np.zeros((min(len(coords), 1), 0), dtype=np.int64), np.zeros(len(coords), dtype=np.int64)
+    if prod(shape) < 1 << 62:
+        flat = np.ravel_multi_index(coords.T, shape)
+        keys, inverse = np.unique(flat, return_inverse=True)
+        return np.stack(np.unravel_index(keys, shape), axis=1).reshape(len(keys), len(shape)), inverse.ravel()
+    keys, inverse = np.unique(coords, axis=0, return_inverse=True)
+    return keys, inverse.ravel()
+
+
+def _join(a: SparseFactor, b: SparseFactor) -> tuple:
+    '''
+    entries of a and b agreeing on their shared variables:
+    (vars, coords, shape, index into a, index into b) with vars = a.vars + the other variables of b
+    '''
+    shared = [v for v in a.vars if v in b.vars]
+    extra = [i for i, v in enumerate(b.vars) if v not in a.vars]
+    if not shared:
+        # 공유하는 변수가 없으면 모든 쌍 (cartesian product)
+        i = np.repeat(np.arange(len(a.values)), len(b.values))
+        j = np.tile(np.arange(len(b.values)), len(a.values))
+    else:
+        dims = [a.cards[v] for v in shared]
+        groups, keys = _group(np.concatenate([a.coords[:, [a.vars.index(v) for v in shared]],
+                                              b.coords[:, [b.vars.index(v) for v in shared]]]), dims)
+        ka, kb = keys[:len(a.values)], keys[len(a.values):]
+
+        # b를 key 순으로 정렬해 a의 각 entry와 짝이 되는 b의 구간을 찾음
+        order = np.argsort(kb, kind='stable')
+        count = np.bincount(kb, minlength=len(groups))
+        start = np.cumsum(count) - count
+        repeat = count[ka]
+        i = np.repeat(np.arange(len(ka)), repeat)
+        offset = np.arange(len(i)) - np.repeat(np.cumsum(repeat) - repeat, repeat)
+        j = order[np.repeat(start[ka], repeat) + offset]
+
+    vars = a.vars + tuple(b.vars[k] for k in extra)
+    coords = np.concatenate([a.coords[i], b.coords[j][:, extra]], axis=1)
+    return vars, coords, a.shape + tuple(b.shape[k] for k in extra), i, j
+
+
+def adapt(f):
+    '''the factor in its better representation: sparse if it is large and has few nonzero entries'''
+    size = prod(f.shape)
+    if isinstance(f, SparseFactor):
+        if size <= DENSE_LIMIT and (size <= SPARSE_MIN or len(f.values) >= DENSITY * size):
+            return f.dense()
+    elif size > SPARSE_MIN and np.count_nonzero(f.values) < DENSITY * size:
+        return f.sparse()
+    return f
+
+
+def contract(factors: Iterable[Factor], keep: Iterable[str]) -> Factor:
+    '''sum over every variable not in keep of the product of factors, as one einsum (a join if any is sparse)'''
+    factors = list(factors)
+    if not factors:
+        return Factor((), np.ones(()))
+    if any(isinstance(f, SparseFactor) for f in factors):
+        # 작은 factor부터 join
+        factors.sort(key=lambda f: f.values.size)
+        out = factors[0].sparse()
+        for f in factors[1:]:
+            out = out * f
+        return out.sum_to(set(keep))
+    labels, cards = dict(), dict()
+    for f in factors:
+        for v, c in zip(f.vars, f.values.shape):
+            labels.setdefault(v, len(labels))
+            assert cards.setdefault(v, c) == c, f'cardinality mismatch on {v}'
+    out = tuple(sorted(v for v in set(keep) if v in labels))
+    operands = []
+    for f in factors:
+        operands += [f.values, [labels[v] for v in f.vars]]
+    return adapt(Factor(out, np.einsum(*operands, [labels[v] for v in out])))
+
+
+class Plan:
+    '''
+    Elimination orders for the product nodes of an expression, with the estimated cost of evaluating it.
+    flops : multiply-adds of every einsum and division
+    peak  : entries of the largest table built (marginals, intermediates and results)
+    '''
+    __slots__ = ('orders', 'flops', 'peak')
+
+    def __init__(self, orders: dict, flops: int, peak: int):
+        self.orders = orders
+        self.flops = flops
+        self.peak = peak
+
+
+    @property
+    def memory(self) -> int:
+        '''bytes of the largest table (float64)'''
+        return 8 * self.peak
+
+
+    def __repr__(self):
+        return f"Plan(flops={self.flops:.3g}, peak={self.peak} entries, memory={self.memory / 2 ** 20:.1f} MiB)"
+
+
+def elimination_order(scopes: Iterable[frozenset], sumset, cards: Mapping[str, int]):
+    '''
+    Greedy variable elimination for sum_{sumset} of a product of factors with the given scopes:
+    repeatedly sums out the variable whose intermediate (product of the factors it appears in,
+    without the variable) is smallest. Returns (order, flops, peak) as in Plan.
+    '''
+    size = lambda vs: prod(cards[v] for v in vs)
+    scopes = [frozenset(s) for s in scopes]
+    remaining = set(sumset) & frozenset().union(*scopes)
+    order, flops, peak = [], 0, 0
+
+    def joined(v):
+        touched = [s for s in scopes if v in s]
+        return touched, frozenset().union(*touched)
+
+    while remaining:
+        # 중간 결과 크기, 연산량, 이름 순으로 선택
+        v = min(remaining, key=lambda v: (size(joined(v)[1] - {v}), size(joined(v)[1]), v))
+        touched, joint = joined(v)
+        flops += size(joint) * len(touched)
+        peak = max(peak, size(joint - {v}))
+        scopes = [s for s in scopes if v not in s] + [joint - {v}]
+        remaining.remove(v)
+        order.append(v)
+
+    # 남은 factor들의 곱
+    if len(scopes) > 1:
+        joint = frozenset().union(*scopes)
+        flops += size(joint) * len(scopes)
+        peak = max(peak, size(joint))
+    return order, flops, peak
+
+
+def plan(P: Probability, cards: Mapping[str, int]) -> Plan:
+    '''
+    Elimination orders and estimated cost of evaluating P, given the cardinality of every variable.
+    Shared subexpressions are counted once, as the Evaluator computes them once.
+    '''
+    orders, scopes = dict(), dict()
+    flops = peak = 0
+    size = lambda vs: prod(cards[v] for v in vs)
+
+    def visit(node) -> frozenset:
+        nonlocal flops, peak
+        if node in scopes:
+            return scopes[node]
+        if not node._recursive:
+            factors = [node._var | node._cond] if node._var else []
+            if node._var and node._cond:
+                # P(var, cond) / P(cond)
+                flops += size(node._var | node._cond)
+            for f in factors:
+                peak = max(peak, size(f))
+        else:
+            factors = [visit(child) for child in node._children]
+        order, f, p = elimination_order(factors, node._sumset, cards)
+        orders[node] = order
+        flops, peak = flops + f, max(peak, p)
+        scope = frozenset().union(*factors) - node._sumset
+        if node._fraction:
+            scope = scope | visit(node._divisor)
+            flops += size(scope)
+            peak = max(peak, size(scope))
+        scopes[node] = scope
+        return scope
+
+    visit(P)
+    return Plan(orders, flops, peak)
+
+
+class JointSource:
+    '''
+    Marginals of a joint distribution given as a tensor with one axis per variable.
+    axes : variable -> axis, or the variable names in axis order
+    '''
+
+    def __init__(self, joint, axes):
+        joint = np.asarray(joint, dtype=float)
+        if not isinstance(axes, Mapping):
+            axes = {v: i for i, v in enumerate(axes)}
+        assert sorted(axes.values()) == list(range(joint.ndim)), 'one variable per axis'
+        self.joint = joint
+        self.axes = dict(axes)
+        self.__marginals = dict()
+
+
+    @property
+    def cards(self) -> dict:
+        return {v: self.joint.shape[i] for v, i in self.axes.items()}
+
+
+    def marginal(self, variables) -> Factor:
+        '''P(variables) (computed once per variable set)'''
+        key = frozenset(variables)
+        if key not in self.__marginals:
+            unknown = key - self.axes.keys()
+            assert not unknown, f'variables not in the joint table: {unknown}'
+            vs = sorted(key)
+            self.__marginals[key] = Factor(vs, np.einsum(self.joint, range(self.joint.ndim),
+                                                         [self.axes[v] for v in vs]))
+        return self.__marginals[key]
+
+
+class Evaluator:
+    '''
+    Evaluates Probability expressions against marginal sources.
+    sources : a single source for every leaf, or do-set -> source for the experiments of gID (P_z leaves)
+    keep    : do variables that stay as axes of the P_z leaves (default: all); the experiments are pooled
+              over the other do variables
+    Shared subexpressions (Probability nodes are hash-consed) are evaluated once.
+    '''
+
+    def __init__(self, sources, keep=None):
+        self.sources = sources
+        self.keep = None if keep is None else frozenset(keep)
+        self.__values = dict()
+        self.__orders = dict()
+
+
+    @property
+    def cards(self) -> dict:
+        if isinstance(self.sources, Mapping):
+            cards = dict()
+            for source in self.sources.values():
+                cards.update(source.cards)
+            return cards
+        return self.sources.cards
+
+
+    def plan(self, P: Probability) -> Plan:
+        '''contraction plan of P, which is also used when evaluating it'''
+        out = plan(P, self.cards)
+        self.__orders.update(out.orders)
+        return out
+
+
+    def source(self, do):
+        if isinstance(self.sources, Mapping):
+            return self.sources[frozenset(do)]
+        return self.sources
+
+
+    def conditional(self, var, cond, do=frozenset()) -> Factor:
+        '''
+        P_do(var | cond) = P_do(var, cond) / P_do(cond)
+        The do variables in keep stay as axes, so a source holding the experiments for every value of do
+        gives the conditional for each of them.
+        '''
+        source = self.source(do)
+        if self.keep is not None:
+            # keep에 없는 do 변수에 대해서는 실험을 합침
+            do = do & self.keep
+        joint = source.marginal(var | cond | do)
+        return joint / source.marginal(cond | do) if cond | do else joint
+
+
+    def __call__(self, P: Probability) -> Factor:
+        value = self.__values.get(P)
+        if value is None:
+            value = self.__values[P] = self.__evaluate(P)
+        return value
+
+
+    def __evaluate(self, P: Probability) -> Factor:
+        if not P._recursive:
+            # P(|cond) = 1
+            factors = [self.conditional(P._var, P._cond, P._do)] if P._var else []
+        else:
+            factors = [self(child) for child in P._children]
+
+        if P not in self.__orders:
+            self.plan(P)
+
+        # 식에 없는 변수에 대한 sumset은 무시
+        variables = set().union(*(f.vars for f in factors))
+        for v in self.__orders[P]:
+            touched = [f for f in factors if v in f.vars]
+            factors = [f for f in factors if v not in f.vars]
+            factors.append(contract(touched, set().union(*(f.vars for f in touched)) - {v}))
+        value = contract(factors, variables - P._sumset)
+
+        if P._fraction:
+            value = value / self(P._divisor)
+        return value
+
+
+def evaluate(P: Probability, joint, axes=None) -> Factor:
+    '''
+    Value of the expression P over a joint distribution (a tensor with axes given by axes, or a source).
+    The result is a Factor over the variables P is not summed over, e.g. (x, y) for P(y | do(x)).
+    Variables the estimand is conditioned on besides the query (e.g. W of ID line 3) stay as axes.
+    '''
+    return Evaluator(JointSource(joint, axes) if axes is not None else joint)(P)
+
+
+def _observed(P: Probability) -> set:
+    '''var and cond variables of every leaf of P'''
+    out, seen, stack = set(), set(), [P]
+    while stack:
+        node = stack.pop()
+        if node in seen:
+            continue
+        seen.add(node)
+        if not node._recursive:
+            out |= node._var | node._cond
+        else:
+            stack.extend(node._children)
+        if node._fraction:
+            stack.append(node._divisor)
+    return out
+
+
+def _weights(evaluator: Evaluator, variables: list) -> np.ndarray:
+    '''P(variables) as a dense array, from the observational source or else the smallest experiment that has them'''
+    sources = evaluator.sources
+    if isinstance(sources, Mapping):
+        sources = [source for _, source in sorted(sources.items(), key=lambda item: len(item[0]))]
+    else:
+        sources = [sources]
+    for source in sources:
+        if set(variables) <= source.cards.keys():
+            return source.marginal(variables).table(*variables)
+    return np.ones([evaluator.cards[v] for v in variables])
+
+
+def interventional(P: Probability, Y: set, X: set, joint, axes=None) -> np.ndarray:
+    '''
+    P(Y | do(X)) for every value of X and Y at once, from the estimand P of myID / mygID (joint and axes as in evaluate).
+    Returns a dense array with axes sorted(X) + sorted(Y); table[x][y] = P(y | do(x)).
+    Experiments (P_z leaves) are pooled over the do variables that are not in X, Y or another leaf of P.
+    Other variables the estimand still depends on (e.g. W of ID line 3, which is intervened on as well) leave the
+    effect unchanged in the population but not in a sample; they are averaged out with P(w) as weights,
+    over the values where the estimand is defined (it sums to 1 over Y).
+    '''
+    evaluator = Evaluator(JointSource(joint, axes) if axes is not None else joint, keep=set(X) | set(Y) | _observed(P))
+    value = evaluator(P)
+    cards = evaluator.cards
+    out = sorted(X) + sorted(Y)
+    extra = [v for v in value.vars if v not in out]
+    table = value.table(*out, *extra)
+    if extra:
+        # 0/0 = 0 으로 정의되지 않은 (x, w)는 Y에 대한 합이 0: 가중치에서 제외 (경험적인 0인 y는 그대로 포함)
+        axes = tuple(range(len(out), len(out) + len(extra)))
+        defined = table.sum(axis=tuple(range(len(X), len(out))), keepdims=True) > 0
+        weights = _weights(evaluator, extra).reshape((1,) * len(out) + table.shape[len(out):]) * defined
+        total = weights.sum(axis=axes)
+        table = np.divide((table * weights).sum(axis=axes), total, out=np.zeros(table.shape[:len(out)]), where=total > 0)
+    return np.broadcast_to(table, [cards[v] for v in out])
@@ -1,7 +1,10 @@
 # from npsem.model import CD
+from copy import copy
+from functools import wraps
+
 from model import CD
 from probability import Probability, get_new_probability
-from utils import get_prev_orders
+from utils import LRUCache, get_prev_orders
 
 # Define exceptions that can occur.
 class HedgeFound(Exception):
@@ -10,6 +13,10 @@ class HedgeFound(Exception):
     def __init__(self, g1, g2, message="Causal effect not identifiable. A hedge has been found:"):
         self._message = message
         super().__init__(self._message + f"\n\nC-Forest 1:\n: {g1} \n\nC-Forest 2:\n: {g2}")
+        self.g1, self.g2 = g1, g2
+
+    def __reduce__(self):
+        return HedgeFound, (self.g1, self.g2, self._message)
 
 
 class ThicketFound(Exception):
@@ -19,25 +26,132 @@ class ThicketFound(Exception):
         self._message = message
         super().__init__(self._message)
 
+    def __reduce__(self):
+        return ThicketFound, (self._message,)
+
+
+# Transposition table of myID / mygID / mysubID calls:
+# (algorithm, Y, X, [Z,] diagram (root index, vertices, cut vertices), P) -> estimand, or the HedgeFound/ThicketFound raised.
+# Shared by the c-component branches of one query and by later queries on the same root diagram.
+# ID_CACHE.info() gives hits / misses / evictions; resize with ID_CACHE.resize(maxsize).
+ID_CACHE = LRUCache(maxsize=1 << 16)
+_MISSING = object()
 
-def myID(Y: set, X: set, G: "CD", P: "Probability" = None, order: list = None, verbose: bool = False, tab: int = 0):
+
+def iterative(key):
+    """
+    Runs an identification algorithm written as a generator of steps on an explicit stack (no Python recursion).
+    A recursive call is written  estimand = yield identify, args  and gets the estimand sent back,
+    or the HedgeFound / ThicketFound it raised thrown in at the yield.
+    Calls are cached in ID_CACHE under key(*args, **kwargs); a key of None (custom order, verbose) bypasses the table.
+    """
+    def decorate(steps):
+        @wraps(steps)
+        def identify(*args, **kwargs):
+            return _run(identify, args, kwargs)
+        identify.steps, identify.key = steps, key
+        return identify
+    return decorate
+
+
+def _run(identify, args: tuple, kwargs: dict):
+    """
+    Drives identify(*args, **kwargs) and its sub-calls with a stack of continuation frames (generator, memo key).
+    Every finished frame is stored in ID_CACHE, an exception included, as it is handed to the frame below it;
+    a cached exception is stored and raised as a fresh copy without traceback.
+    """
+    frames = []
+    call, value, error = (identify, args, kwargs), None, None
+    while True:
+        if call is not None:
+            identify, args, kwargs = call
+            key = identify.key(*args, **kwargs)
+            out = _MISSING if key is None else ID_CACHE.get(key, _MISSING)
+            if out is _MISSING:
+                frames.append((identify.steps(*args, **kwargs), key))
+                value = None
+            elif isinstance(out, Exception):
+                # 매번 새 exception으로 raise (cache에 있는 것에 traceback이 쌓이지 않도록)
+                error = copy(out)
+            else:
+                value = out
+            call = None
+        if not frames:
+            if error is not None:
+                raise error
+            return value
+
+        steps, key = frames[-1]
+        try:
+            identify, args = steps.send(value) if error is None else steps.throw(error)
+            call, error = (identify, args, {}), None
+            continue
+        except StopIteration as stop:
+            value, error = stop.value, None
+        except (HedgeFound, ThicketFound) as e:
+            error = e.with_traceback(None)
+        frames.pop()
+        if key is not None:
+            ID_CACHE.put(key, value if error is None else copy(error))
+
+
+def _diagram_key(G: "CD") -> tuple:
+    # 같은 root에서 induced / do로 만든 diagram은 (index, vertices, cut)으로 결정됨
+    return G._index, G._v, G._cut
+
+
+# c-component branch를 executor로 나눠 계산하는 최소 vertex 수 (작은 문제는 overhead가 더 큼)
+PARALLEL_MIN_VERTICES = 64
+
+
+def branches(identify, calls: list, size: int, executor=None):
+    """
+    Estimands of identify(*args) for the independent c-component branches (ID line 4, gID line 6),
+    used as  probabilities = yield from branches(...)  inside a step generator.
+    With a concurrent.futures executor (threads or processes) and a sub-problem of at least
+    PARALLEL_MIN_VERTICES vertices, the branches run on the executor; deeper branches of them run sequentially.
+    The product is the same either way: children are a set of hash-consed nodes, and the first
+    failing branch in order raises as in the sequential loop.
+    """
+    if executor is None or size < PARALLEL_MIN_VERTICES:
+        probabilities = set()
+        for args in calls:
+            probabilities.add((yield identify, args))
+        return probabilities
+    futures = [executor.submit(identify, *args) for args in calls]
+    return {future.result() for future in futures}
+
+
+def preceding(G: "CD", vertex: str, order: list = None) -> set:
+    """
+    Vertices of G before vertex in the topological order (V_π^(i-1) in line 6, 7, 14, 15).
+    Without a custom order, G.causal_order() is used through a direct position lookup.
+    """
+    if not order:
+        return G.preceding(vertex)
+    new_order = get_prev_orders(order, G.V)
+    return set(new_order[:new_order.index(vertex)])
+
+
+@iterative(lambda Y, X, G, P=None, order=None, verbose=False, tab=0, executor=None:
+          None if order or verbose else ('ID', frozenset(Y), frozenset(X), _diagram_key(G), P))
+def myID(Y: set, X: set, G: "CD", P: "Probability" = None, order: list = None, verbose: bool = False, tab: int = 0,
+         executor=None):
     """
     OUTPUT : Expression in Latex 
     Shpitser, Pearl 2006
     [Identification of Joint Interventional Distributions in Recursive Semi-Markovian Causal Models]
+    order : custom topological order (default: G.causal_order())
     """
 
     Vs = G.V
-    if not order: order = G.causal_order()
     if not P: P = Probability(var=Vs)
 
     # Line 1
     if not X:
         if verbose: print(f"[(ID) line 1]")
 
-        P_out = P.copy()
-        P_out._sumset = P._sumset | (Vs - Y)
-        P_out.simplify()
+        P_out = P.replace(sumset=P._sumset | (Vs - Y)).simplify()
 
         return P_out
         
@@ -45,28 +159,24 @@ def myID(Y: set, X: set, G: "CD", P: "Probability" = None, order: list = None, v
     if Vs != G.An(Y):
         if verbose: print(f"[(ID) line 2]\tVs: {Vs}  G.An(Y): {G.An(Y)}")
 
-        P_out = P.copy()
-        P_out._sumset = P._sumset | (Vs - G.An(Y))
-        P_out.simplify()
+        P_out = P.replace(sumset=P._sumset | (Vs - G.An(Y))).simplify()
 
-        return myID(Y, X & G.An(Y), G[G.An(Y)], P_out, order, verbose, tab=tab + 1)
+        return (yield myID, (Y, X & G.An(Y), G[G.An(Y)], P_out, order, verbose, tab + 1, executor))
     
     # line 3
     if W:=(Vs - X) - G.do(X).An(Y):
         if verbose: print(f"[(ID) line 3]\tW: {W}")
 
-        return myID(Y, X | W, G, P, order, verbose, tab=tab + 1)
+        return (yield myID, (Y, X | W, G, P, order, verbose, tab + 1, executor))
 
     # line 4
     if len(CCs := G[Vs - X].c_components) > 1:
         if verbose: print(f"[(ID) line 4]\tCCs: {CCs}")
         
-        probabilities = set()
-        for CC in CCs:
-            probabilities.add(myID(CC, Vs - CC, G, P, order, verbose, tab=tab + 1))
+        probabilities = yield from branches(myID, [(CC, Vs - CC, G, P, order, verbose, tab + 1) for CC in CCs], len(Vs), executor)
         
         P_out = Probability(recursive=True, children=probabilities, sumset=Vs - (Y | X))
-        P_out.simplify()
+        P_out = P_out.simplify()
 
         return P_out
 
@@ -81,17 +191,15 @@ def myID(Y: set, X: set, G: "CD", P: "Probability" = None, order: list = None, v
         # line 6
         if S in G.c_components:
             if verbose: print(f"[(ID) line 6]\tS: {S}    C(G): {G.c_components}")
-            breakpoint()
 
             probabilities = set()
             for vertex in S:
-                new_order = get_prev_orders(order, Vs)
-                cond = set(new_order[:new_order.index(vertex)])
+                cond = preceding(G, vertex, order)
                 P_i = get_new_probability(P, {vertex}, cond=cond)
                 probabilities.add(P_i)
 
             P_out = Probability(recursive=True, children=probabilities, sumset=S - Y)
-            P_out.simplify() 
+            P_out = P_out.simplify()
 
             return P_out
         
@@ -102,18 +210,86 @@ def myID(Y: set, X: set, G: "CD", P: "Probability" = None, order: list = None, v
                 
                 probabilities = set()
                 for vertex in S_prime:
-                    new_order = get_prev_orders(order, Vs)
-                    cond = set(new_order[:new_order.index(vertex)])
+                    cond = preceding(G, vertex, order)
                     P_i = get_new_probability(P, {vertex}, cond=cond)
                     probabilities.add(P_i)
 
                 P_out = Probability(recursive=True, children=probabilities, scope=S_prime)
-                P_out.simplify()
+                P_out = P_out.simplify()
+
+                return (yield myID, (Y, X & S_prime, G[S_prime], P_out, order, verbose, tab + 1, executor))
+
+
+def identify_many(G: "CD", queries, Z: list = None, order: list = None, verbose: bool = False):
+    """
+    Identifies a batch of (Y, X) queries against the same diagram, yielding (Y, X, estimand) as each one is done.
+    With Z (surrogate experiments) mygID is used, otherwise myID.
+    Ancestor/descendant sets, c-components and the causal order of G are computed once up front (G.precompute());
+    derived diagrams are shared through DIAGRAM_CACHE and sub-estimands through ID_CACHE across the batch.
+    A query that is not identifiable yields its HedgeFound / ThicketFound instead of raising.
+    """
+    G.precompute()
+    for Y, X in queries:
+        Y, X = set(Y), set(X)
+        try:
+            if Z is None:
+                yield Y, X, myID(Y, X, G, order=order, verbose=verbose)
+            else:
+                yield Y, X, mygID(Y, X, Z, G, verbose=verbose)
+        except (HedgeFound, ThicketFound) as e:
+            yield Y, X, e
+
+
+def _raise_timeout(signum, frame):
+    raise TimeoutError('identification timed out')
+
+
+def _init_worker():
+    import signal
+    if hasattr(signal, 'SIGALRM'):
+        signal.signal(signal.SIGALRM, _raise_timeout)
+
+
+def _identify_task(task):
+    """worker of identify_parallel: (i, G, Y, X, Z, timeout) -> (i, estimand or the exception)"""
+    import signal
+    i, G, Y, X, Z, timeout = task
+    timed = timeout is not None and hasattr(signal, 'SIGALRM')
+    if timed:
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return i, myID(Y, X, G) if Z is None else mygID(Y, X, Z, G)
+    except (HedgeFound, ThicketFound, TimeoutError) as e:
+        return i, e
+    finally:
+        if timed:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+def identify_parallel(problems, processes: int = None, chunksize: int = 16, timeout: float = None,
+                      ordered: bool = True):
+    """
+    Identifies (G, Y, X) problems, or (G, Y, X, Z) for mygID, over a pool of worker processes,
+    yielding (i, estimand) where i is the position of the problem in problems.
+    Diagrams are sent in their compact pickled form (CausalDiagram.__reduce__) chunksize problems at a time.
+    HedgeFound / ThicketFound, and TimeoutError for a problem running longer than timeout seconds
+    (where SIGALRM is available), come back as the estimand instead of raising.
+    ordered=False yields results as they finish.
+    """
+    from multiprocessing import Pool
+
+    def tasks():
+        for i, (G, Y, X, *Z) in enumerate(problems):
+            yield i, G, set(Y), set(X), (Z[0] if Z else None), timeout
 
-                return myID(Y, X & S_prime, G[S_prime], P_out, order, verbose, tab=tab + 1)
+    with Pool(processes, initializer=_init_worker) as pool:
+        run = pool.imap if ordered else pool.imap_unordered
+        yield from run(_identify_task, tasks(), chunksize)
 
 
-def mygID(Y: set, X: set, Z:set, G: "CD", P: "Probability" = None, verbose: bool = False, tab: int = 0):
+@iterative(lambda Y, X, Z, G, P=None, verbose=False, tab=0, executor=None:
+          None if verbose else ('gID', frozenset(Y), frozenset(X), tuple(frozenset(z) for z in Z), _diagram_key(G), P))
+def mygID(Y: set, X: set, Z:set, G: "CD", P: "Probability" = None, verbose: bool = False, tab: int = 0, executor=None):
     """
     OUTPUT : Expression in Latex 
     Lee, Correa, Bareinboim 2019
@@ -127,10 +303,7 @@ def mygID(Y: set, X: set, Z:set, G: "CD", P: "Probability" = None, verbose: bool
         if X == z & Vs:
             if verbose: print(f"[(gID) line 2]\tX: {X}    Z∩V: {z & Vs}")
             
-            P_out = P.copy()
-            P_out._do = (z - Vs) | X
-            P_out._sumset = P._sumset | (Vs - Y)
-            P_out.simplify()
+            P_out = P.replace(do=(z - Vs) | X, sumset=P._sumset | (Vs - Y)).simplify()
 
             return P_out
 
@@ -138,28 +311,24 @@ def mygID(Y: set, X: set, Z:set, G: "CD", P: "Probability" = None, verbose: bool
     if Vs != G.An(Y):
         if verbose: print(f"[(gID) line 3]\tVs: {Vs}  G.An(Y): {G.An(Y)}")
         
-        P_out = P.copy()
-        P_out._sumset = P._sumset | (Vs - G.An(Y))
-        P_out.simplify()
+        P_out = P.replace(sumset=P._sumset | (Vs - G.An(Y))).simplify()
 
-        return mygID(Y, X & G.An(Y), Z, G[G.An(Y)], P_out, verbose, tab=tab + 1)
+        return (yield mygID, (Y, X & G.An(Y), Z, G[G.An(Y)], P_out, verbose, tab + 1, executor))
     
     # line 4
     if W := (Vs - X) - G.do(X).An(Y):
         if verbose: print(f"[(gID) line 4]\tW: {W}")
 
-        return mygID(Y, X | W, Z, G, P, verbose, tab=tab+1)
+        return (yield mygID, (Y, X | W, Z, G, P, verbose, tab + 1, executor))
     
     # line 6
     if len(CCs := G[Vs - X].c_components) > 1:
         if verbose: print(f"[(gID) line 6]\tG(C\X): {CCs}")
 
-        probabilities= set()
-        for CC in CCs:
-            probabilities.add(mygID(CC, Vs - CC, Z, G, P, verbose, tab=tab+1))
+        probabilities = yield from branches(mygID, [(CC, Vs - CC, Z, G, P, verbose, tab + 1) for CC in CCs], len(Vs), executor)
         
         P_out = Probability(recursive=True, children=probabilities, sumset=Vs - (Y | X)) 
-        P_out.simplify()
+        P_out = P_out.simplify()
 
         return P_out
         
@@ -168,12 +337,9 @@ def mygID(Y: set, X: set, Z:set, G: "CD", P: "Probability" = None, verbose: bool
         if X >= z & Vs:
             if verbose: print(f"[(gID) line 7]\tX: {X}    Z∩V: {z & Vs}")
 
-            P_out = P.copy()
-            P_out._do = (z - Vs) | (X & z)
-            P_out._var = Vs       # useless?
-            P_out.simplify()
+            P_out = P.replace(do=(z - Vs) | (X & z), var=Vs).simplify()   # var=Vs: useless?
 
-            result = mysubID(Y, X - z, G[Vs - (z & X)], P_out, verbose=verbose, tab=tab+1) 
+            result = yield mysubID, (Y, X - z, G[Vs - (z & X)], P_out, None, verbose, tab + 1)
             
             if result: return result
 
@@ -182,19 +348,18 @@ def mygID(Y: set, X: set, Z:set, G: "CD", P: "Probability" = None, verbose: bool
     raise ThicketFound()   
         
 
+@iterative(lambda Y, X, G, Q, order=None, verbose=False, tab=0:
+          None if order or verbose else ('subID', frozenset(Y), frozenset(X), _diagram_key(G), Q))
 def mysubID(Y: set, X: set, G: "CD", Q: "Probability", order: list = None, verbose: bool = False, tab: int = 0):
 
     Vs = G.V
-    if not order: order = G.causal_order()
     S = next(iter(G[Vs - X].c_components))
     
     # line 11
     if not X:
         if verbose: print("[(subID) line 11]")
         
-        Q_out = Q.copy()
-        Q_out._sumset = Q._sumset | (Vs - Y)
-        Q_out.simplify()
+        Q_out = Q.replace(sumset=Q._sumset | (Vs - Y)).simplify()
 
         return Q_out
 
@@ -202,11 +367,9 @@ def mysubID(Y: set, X: set, G: "CD", Q: "Probability", order: list = None, verbo
     if Vs != G.An(Y):
         if verbose: print(f"[(subID) line 12]\tVs: {Vs}  G.An(Y): {G.An(Y)}")
         
-        Q_out = Q.copy()
-        Q_out._sumset = Q._sumset | (Vs - G.An(Y))
-        Q_out.simplify()
+        Q_out = Q.replace(sumset=Q._sumset | (Vs - G.An(Y))).simplify()
 
-        return mysubID(Y, X & G.An(Y), G[G.An(Y)], Q_out, order, verbose, tab=tab + 1)
+        return (yield mysubID, (Y, X & G.An(Y), G[G.An(Y)], Q_out, order, verbose, tab + 1))
     
     # line 13
     if (CCs:=G.c_components) == {Vs}:
@@ -220,13 +383,12 @@ def mysubID(Y: set, X: set, G: "CD", Q: "Probability", order: list = None, verbo
         
         probabilities = set()
         for vertex in S:
-            new_order = get_prev_orders(order, Vs)
-            cond = set(new_order[:new_order.index(vertex)])
+            cond = preceding(G, vertex, order)
             Q_i = get_new_probability(Q, {vertex}, cond=cond)
             probabilities.add(Q_i)
 
         Q_out = Probability(recursive=True, children=probabilities, sumset=S - Y)
-        Q_out.simplify()
+        Q_out = Q_out.simplify()
 
         return Q_out
     
@@ -237,15 +399,14 @@ def mysubID(Y: set, X: set, G: "CD", Q: "Probability", order: list = None, verbo
 
             probabilities = set()
             for vertex in S_prime:
-                new_order = get_prev_orders(order, Vs)
-                cond = set(new_order[:new_order.index(vertex)])
+                cond = preceding(G, vertex, order)
                 Q_i = get_new_probability(Q, {vertex}, cond=cond)
                 probabilities.add(Q_i)
             
             Q_out = Probability(recursive=True, children=probabilities, scope=S_prime)
-            Q_out.simplify()
+            Q_out = Q_out.simplify()
             
-            return mysubID(Y, X & S_prime, G[S_prime], Q_out, order, verbose, tab=tab + 1)
+            return (yield mysubID, (Y, X & S_prime, G[S_prime], Q_out, order, verbose, tab + 1))
 
 
 if __name__ == "__main__":
@@ -1,98 +1,381 @@
-import functools
+import heapq
 import itertools
-import networkx as nx
-import matplotlib.pyplot as plt
 
 from typing import FrozenSet, Tuple
 from collections import defaultdict
 from typing import Iterable, Optional, Set, Sequence, AbstractSet
-from utils import fzset_union, sortup, sortup2, dict_only, dict_except, pairs2dict, wrap
+from utils import fzset_union, sortup, sortup2, wrap, bits, pairs2dict, LRUCache
+
+
+class VertexIndex:
+    '''
+    Interning table between vertex names and integer indices.
+    A root diagram and every diagram derived from it (induced, do) share one index,
+    so that vertex sets can be handled as int bitmasks.
+    Names are interned in causal order, so the index of a vertex is also its position.
+    '''
+    __slots__ = ('names', 'index')
+
+    def __init__(self, names: Iterable[str]):
+        self.names = tuple(names)
+        self.index = {v: i for i, v in enumerate(self.names)}
+
+
+    def __len__(self):
+        return len(self.names)
+
+
+    def mask(self, v_or_vs) -> int:
+        # index에 없는 vertex는 무시 (defaultdict(frozenset)처럼 빈 집합 취급)
+        if isinstance(v_or_vs, str):
+            i = self.index.get(v_or_vs)
+            return 0 if i is None else 1 << i
+        m = 0
+        for v in v_or_vs:
+            i = self.index.get(v)
+            if i is not None:
+                m |= 1 << i
+        return m
+
+
+    def names_of(self, mask: int) -> FrozenSet[str]:
+        names = self.names
+        return frozenset(names[i] for i in bits(mask))
+
+
+class CComponents:
+    '''
+    C-components of a diagram as disjoint bitmasks (with their vertex names cached).
+    A diagram derived by induced()/do() only re-splits the components touched by the change,
+    with a union-find over the remaining bidirected edges; the other components are shared as they are.
+    '''
+    __slots__ = ('_index', '_components')
+
+    def __init__(self, index: VertexIndex, components: dict):
+        self._index = index
+        self._components = components   # component bitmask -> frozenset of vertex names
+
+
+    @classmethod
+    def of(cls, index: VertexIndex, vertices: int, bidirected: dict) -> 'CComponents':
+        return cls(index, {cc: index.names_of(cc) for cc in cls._split(vertices, bidirected)})
+
+
+    @staticmethod
+    def _split(vertices: int, bidirected: dict) -> list:
+        parent = {i: i for i in bits(vertices)}
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for i in parent:
+            for j in bits(bidirected[i] & vertices):
+                if j > i:
+                    ri, rj = find(i), find(j)
+                    if ri != rj:
+                        parent[rj] = ri
+
+        ccs = defaultdict(int)
+        for i in parent:
+            ccs[find(i)] |= 1 << i
+        return list(ccs.values())
+
+
+    def restricted(self, vertices: int, bidirected: dict, touched: int = 0) -> 'CComponents':
+        '''
+        C-components after keeping only `vertices` and changing the bidirected edges of `touched` vertices.
+        '''
+        components = dict()
+        for cc, names in self._components.items():
+            if not cc & touched and cc & vertices == cc:
+                components[cc] = names
+            elif cc & vertices:
+                for sub in self._split(cc & vertices, bidirected):
+                    components[sub] = names if sub == cc else self._index.names_of(sub)
+        return CComponents(self._index, components)
+
+
+    @property
+    def masks(self):
+        return self._components.keys()
+
+
+    @property
+    def named(self) -> FrozenSet[FrozenSet[str]]:
+        return frozenset(self._components.values())
+
+
+# Interning table of derived diagrams shared by every CausalDiagram.
+# G[S] and G.do(X) depend only on the root diagram (its VertexIndex), the remaining vertices
+# and the vertices whose incoming/bidirected edges are cut, so repeated requests return the same object.
+# Resize with DIAGRAM_CACHE.resize(maxsize, maxweight); the weight of a diagram is the 64-bit words it can hold
+# (see _stored_words), so maxweight bounds the memory of the table (1 << 24 words = 128 MB).
+DIAGRAM_CACHE = LRUCache(maxsize=4096, maxweight=1 << 24, weigher=lambda G: _stored_words(G))
 
 
 class CausalDiagram:
+    __slots__ = ('V', '_index', '_v', '_cut', '_pa_bits', '_ch_bits', '_bi_bits', '_an_bits', '_de_bits',
+                 '_u_pairs', '_eager_closure', '__confounded_dict', '__U', '__order', '__cc', '__cc_dict',
+                 '__ccs', '__ccs_from', '__edges', '__u_pas', '__h', '__characteristic')
+
     def __init__(self,
                  vs: Optional[Iterable[str]],
                  directed_edges: Optional[Iterable[Tuple[str, str]]] = frozenset(),
                  bidirected_edges: Optional[Iterable[Tuple[str, str, str]]] = frozenset(),
                  copy: 'CausalDiagram' = None,
                  with_do: Optional[Set[str]] = None,
-                 with_induced: Optional[Set[str]] = None):
+                 with_induced: Optional[Set[str]] = None,
+                 eager_closure: bool = False):
+        '''
+        eager_closure: compute every ancestor/descendant set in one topological pass at construction.
+                       Diagrams derived with induced/do inherit the mode and restrict the parent's closure,
+                       recomputing only the vertices whose ancestors/descendants actually changed.
+        '''
         with_do = wrap(with_do)
         with_induced = wrap(with_induced)
 
+        # vertex set과 adjacency는 모두 index를 공유하는 int bitmask로 저장
+        # _pa_bits, _ch_bits, _bi_bits: vertex index -> parents / children / bidirected neighbors
+        #                               root는 tuple, 파생된 diagram은 V의 vertex만 가진 dict (크기가 |V|에 비례)
+        # _an_bits, _de_bits: vertex index -> ancestors / descendants (cache)
+        # _u_pairs: (i, j) (i < j) -> U's confounding the pair; root diagram의 것을 공유하고
+        # 파생된 diagram에서 남아 있는 pair인지는 _bi_bits로 판단
         if copy is not None:
+            self._index = copy._index
+            self._eager_closure = copy._eager_closure
+            self._u_pairs = copy._u_pairs
             if with_do is not None:
+                d = copy._v & copy._index.mask(with_do)
+                self._v = copy._v
+                self._cut = copy._cut | d
                 self.V = copy.V
-                self.U = wrap(u for u in copy.U if with_do.isdisjoint(copy.confounded_dict[u]))
-                self.confounded_dict = {u: val for u, val in copy.confounded_dict.items() if u in self.U}
-
-                # copy cautiously
-                dopa = copy.pa(with_do)
-                doAn = copy.An(with_do)
-                doDe = copy.De(with_do)
 
-                self._pa = defaultdict(frozenset, {k: frozenset() if k in with_do else v for k, v in copy._pa.items()})
-                self._ch = defaultdict(frozenset, {k: (v - with_do) if k in dopa else v for k, v in copy._ch.items()})
-                self._an = dict_except(copy._an, doDe)
-                self._de = dict_except(copy._de, doAn)
+                self._pa_bits = {i: 0 if d >> i & 1 else copy._pa_bits[i] for i in bits(copy._v)}
+                self._ch_bits = {i: copy._ch_bits[i] & ~d for i in bits(copy._v)}
+                self._bi_bits = {i: 0 if d >> i & 1 else copy._bi_bits[i] & ~d for i in bits(copy._v)}
+                # edge가 끊긴 경로가 있는 vertex의 cache만 버림
+                self._an_bits = {i: an for i, an in copy._an_bits.items() if not (an | 1 << i) & d}
+                self._de_bits = {i: de for i, de in copy._de_bits.items() if not de & d}
+                ccs_from = (copy, self._v, d)
 
-            elif with_induced is not None: 
+            elif with_induced is not None:
                 assert with_induced <= copy.V
-                removed = copy.V - with_induced
+                s = copy._index.mask(with_induced)
+                self._v = s
+                self._cut = copy._cut & s
                 self.V = with_induced
-                self.confounded_dict = {u: val for u, val in copy.confounded_dict.items() if val <= self.V}
-                self.U = wrap(self.confounded_dict)
-
-                children_are_removed = copy.pa(removed) & self.V
-                parents_are_removed = copy.ch(removed) & self.V
-                ancestors_are_removed = copy.de(removed) & self.V
-                descendants_are_removed = copy.an(removed) & self.V
-
-                self._pa = defaultdict(frozenset, {x: (copy._pa[x] - removed) if x in parents_are_removed else copy._pa[x] for x in self.V})
-                self._ch = defaultdict(frozenset, {x: (copy._ch[x] - removed) if x in children_are_removed else copy._ch[x] for x in self.V})
-                self._an = dict_only(copy._an, self.V - ancestors_are_removed)
-                self._de = dict_only(copy._de, self.V - descendants_are_removed)
+
+                # S의 vertex만 보므로 O(|S|)
+                self._pa_bits = {i: copy._pa_bits[i] & s for i in bits(s)}
+                self._ch_bits = {i: copy._ch_bits[i] & s for i in bits(s)}
+                self._bi_bits = {i: copy._bi_bits[i] & s for i in bits(s)}
+                # 제거된 vertex를 거치지 않는 vertex의 cache는 그대로 사용
+                removed = copy._v & ~s
+                self._an_bits = {i: an for i in bits(s) if (an := copy._an_bits.get(i)) is not None and not an & removed}
+                self._de_bits = {i: de for i in bits(s) if (de := copy._de_bits.get(i)) is not None and not de & removed}
+                ccs_from = (copy, s, 0)
             else:
+                self._v = copy._v
+                self._cut = copy._cut
                 self.V = copy.V
-                self.U = copy.U
-                self.confounded_dict = copy.confounded_dict
-                self._ch = copy._ch
-                self._pa = copy._pa
-                self._an = copy._an
-                self._de = copy._de
+                self._pa_bits = copy._pa_bits
+                self._ch_bits = copy._ch_bits
+                self._bi_bits = copy._bi_bits
+                self._an_bits = copy._an_bits
+                self._de_bits = copy._de_bits
+                ccs_from = (copy, self._v, 0)
+            confounded_dict = None
         else:
             directed_edges = list(directed_edges)
             bidirected_edges = list(bidirected_edges)
             self.V = frozenset(vs) | fzset_union(directed_edges) | fzset_union((x, y) for x, y, _ in bidirected_edges)
-            self.U = frozenset(u for _, _, u in bidirected_edges)
-            self.confounded_dict = {u: frozenset({x, y}) for x, y, u in
-                                    bidirected_edges}
-
-            self._ch = pairs2dict(directed_edges)
-            self._pa = pairs2dict(directed_edges, backward=True)
-            self._an = dict()  # cache
-            self._de = dict()  # cache
-            assert self._ch.keys() <= self.V and self._pa.keys() <= self.V
-        
-        if bidirected_edges == None:
-            self.bidirected_edges = []
-        else:
-            self.bidirected_edges = list(bidirected_edges)
-        self.edges = tuple((x, y) for x, ys in self._ch.items() for y in ys)
-
-        self.causal_order = functools.lru_cache()(self.causal_order)
-        self._do_ = functools.lru_cache()(self._do_)
+            confounded_dict = {u: frozenset({x, y}) for x, y, u in
+                               bidirected_edges}
+
+            self._index = VertexIndex(topological_sort(self.V, directed_edges))
+            index = self._index.index
+            self._v = (1 << len(self._index)) - 1
+            self._cut = 0   # do()로 incoming edge가 끊긴 vertices
+            pa_bits, ch_bits, bi_bits = [0] * len(self._index), [0] * len(self._index), [0] * len(self._index)
+            for x, y in directed_edges:
+                ch_bits[index[x]] |= 1 << index[y]
+                pa_bits[index[y]] |= 1 << index[x]
+            self._u_pairs = defaultdict(tuple)
+            for u, (x, y) in confounded_dict.items():
+                i, j = sorted((index[x], index[y]))
+                bi_bits[i] |= 1 << j
+                bi_bits[j] |= 1 << i
+                self._u_pairs[i, j] += (u,)
+            self._pa_bits, self._ch_bits, self._bi_bits = tuple(pa_bits), tuple(ch_bits), tuple(bi_bits)
+            self._an_bits = dict()  # cache
+            self._de_bits = dict()  # cache
+            self._eager_closure = eager_closure
+            ccs_from = None
+
+        self.__init_caches(confounded_dict, ccs_from)
+
+
+    def __init_caches(self, confounded_dict: Optional[dict], ccs_from: Optional[tuple]):
+        if self._eager_closure:
+            self.__ensure_closure()
+
+        self.__confounded_dict = confounded_dict
+        self.__U = None
+
+        self.__order = None
         self.__cc = None
         self.__cc_dict = None
+        self.__ccs = None
+        # c-components는 부모 diagram의 것에서 바뀐 부분만 다시 계산 (lazy)
+        self.__ccs_from = ccs_from
+        self.__edges = None
+        self.__u_pas = None
         self.__h = None
         self.__characteristic = None
-        self.__confoundeds = None
-        self.u_pas = defaultdict(set)
-        for u, xy in self.confounded_dict.items():
-            for v in xy:
-                self.u_pas[v].add(u)
 
-        self.u_pas = defaultdict(set, {v: frozenset(us) for v, us in self.u_pas.items()})
+
+    @classmethod
+    def from_arrays(cls, names: Sequence[str], directed, bidirected=None,
+                    u_names: Optional[Sequence[str]] = None, eager_closure: bool = False) -> 'CausalDiagram':
+        '''
+        Bulk constructor from integer edge arrays, without a Python tuple per edge.
+        names       : vertex names, vertex i is names[i]
+        directed    : int array of shape (E, 2) with rows (parent, child)
+        bidirected  : int array of shape (B, 2)
+        u_names     : names of the B confounders (default: U{i}_{j} for the causal order positions i < j of the pair,
+                      generated on demand)
+        '''
+        import numpy as np
+
+        n = len(names)
+        directed = _edge_array(directed, n)
+        bidirected = _edge_array(bidirected, n)
+        names_array = np.asarray(names, dtype=str)
+        assert len(np.unique(names_array)) == n, 'vertex names must be unique'
+
+        # causal order로 index를 다시 매김
+        order = _array_topological_order(directed[:, 0], directed[:, 1], names_array)
+        position = np.empty(n, dtype=np.int64)
+        position[order] = np.arange(n)
+        pa, ch = position[directed[:, 0]], position[directed[:, 1]]
+        bx, by = position[bidirected[:, 0]], position[bidirected[:, 1]]
+
+        G = cls.__new__(cls)
+        G._index = VertexIndex(names_array[order].tolist())
+        G.V = frozenset(G._index.names)
+        G._v = (1 << n) - 1
+        G._cut = 0
+        G._pa_bits = _bitmask_rows(ch, pa, n)
+        G._ch_bits = _bitmask_rows(pa, ch, n)
+        G._bi_bits = _bitmask_rows(np.concatenate([bx, by]), np.concatenate([by, bx]), n)
+        if u_names is None:
+            G._u_pairs = GeneratedUNames(G._bi_bits)
+        else:
+            assert len(u_names) == len(bidirected)
+            G._u_pairs = defaultdict(tuple)
+            for i, j, u in zip(np.minimum(bx, by).tolist(), np.maximum(bx, by).tolist(), u_names):
+                G._u_pairs[i, j] += (u,)
+        G._an_bits = dict()
+        G._de_bits = dict()
+        G._eager_closure = eager_closure
+        G.__init_caches(None, None)
+        return G
+
+
+    @classmethod
+    def from_adjacency(cls, names: Sequence[str], adjacency, bidirected=None, eager_closure: bool = False) -> 'CausalDiagram':
+        '''
+        Bulk constructor from adjacency matrices: adjacency[i, j] != 0 for i -> j and
+        bidirected[i, j] != 0 (or bidirected[j, i]) for i <-> j.
+        Dense NumPy arrays and sparse matrices (anything with tocoo()) are accepted.
+        '''
+        import numpy as np
+
+        directed = np.stack(_nonzero(adjacency), axis=1)
+        if bidirected is not None:
+            bidirected = np.stack(_nonzero(bidirected), axis=1)
+            bidirected = np.unique(np.sort(bidirected, axis=1), axis=0)
+        return cls.from_arrays(names, directed, bidirected, eager_closure=eager_closure)
+
+
+    @classmethod
+    def _decode(cls, names: Sequence[str], parents, confounded) -> 'CausalDiagram':
+        '''diagram from the encoding of __reduce__, interning names in the given (causal) order without sorting again'''
+        n = len(names)
+        pa_bits, ch_bits, bi_bits = [0] * n, [0] * n, [0] * n
+        for i, ps in enumerate(parents):
+            for j in ps:
+                pa_bits[i] |= 1 << j
+                ch_bits[j] |= 1 << i
+        u_pairs = defaultdict(tuple)
+        for i, j, u in confounded:
+            i, j = sorted((i, j))
+            bi_bits[i] |= 1 << j
+            bi_bits[j] |= 1 << i
+            u_pairs[i, j] += (u,)
+
+        G = cls.__new__(cls)
+        G._index = VertexIndex(names)
+        G.V = frozenset(G._index.names)
+        G._v = (1 << n) - 1
+        G._cut = 0
+        G._pa_bits, G._ch_bits, G._bi_bits = tuple(pa_bits), tuple(ch_bits), tuple(bi_bits)
+        G._u_pairs = u_pairs
+        G._an_bits = dict()
+        G._de_bits = dict()
+        G._eager_closure = False
+        G.__init_caches(None, None)
+        return G
+
+
+    @property
+    def edges(self) -> Tuple[Tuple[str, str], ...]:
+        if self.__edges is None:
+            names = self._index.names
+            self.__edges = tuple((names[i], names[j]) for i in bits(self._v) for j in bits(self._ch_bits[i]))
+        return self.__edges
+
+
+    @property
+    def confounded_dict(self) -> dict:
+        if self.__confounded_dict is None:
+            names = self._index.names
+            self.__confounded_dict = {u: frozenset({names[i], names[j]}) for i, j in self._bi_pairs()
+                                      for u in self._u_pairs[i, j]}
+        return self.__confounded_dict
+
+
+    def _bi_pairs(self):
+        # 남아 있는 bidirected edge (i < j); root의 _u_pairs 전체가 아니라 V의 vertex만 봄
+        for i in bits(self._v):
+            for j in bits(self._bi_bits[i] >> (i + 1)):
+                yield i, i + 1 + j
+
+
+    @property
+    def U(self) -> FrozenSet:
+        if self.__U is None:
+            self.__U = frozenset(self.confounded_dict)
+        return self.__U
+
+
+    @property
+    def bidirected_edges(self):
+        return [(x, y, u) for u, (x, y) in self.confounded_dict.items()]
+
+
+    @property
+    def u_pas(self):
+        if self.__u_pas is None:
+            u_pas = defaultdict(set)
+            for u, xy in self.confounded_dict.items():
+                for v in xy:
+                    u_pas[v].add(u)
+            self.__u_pas = defaultdict(set, {v: frozenset(us) for v, us in u_pas.items()})
+        return self.__u_pas
 
 
     def UCs(self, v):
@@ -107,10 +390,10 @@ class CausalDiagram:
                 x, y = item
                 return self.is_confounded(x, y)
             else:                   
-                return tuple(item) in self.edges
+                return self.has_edge(*item)
         if len(item) == 3:
             x, y, u = item          
-            return self.is_confounded(x, y) and u in self.confounded_dict and self.confounded_dict[u] == frozenset({x, y})
+            return self.is_confounded(x, y) and u in self._u_pairs[self.__pair(x, y)]
         return False
 
 
@@ -138,22 +421,31 @@ class CausalDiagram:
         return self >= other and self != other
 
 
+    def _mask(self, v_or_vs) -> int:
+        return self._index.mask(v_or_vs) & self._v
+
+
+    def _names(self, mask: int) -> FrozenSet:
+        return self._index.names_of(mask)
+
+
+    def _union(self, adjacency: dict, mask: int) -> int:
+        out = 0
+        for i in bits(mask):
+            out |= adjacency[i]
+        return out
+
+
     def Pa(self, v_or_vs) -> FrozenSet:
         return self.pa(v_or_vs) | wrap(v_or_vs, frozenset)
 
 
     def pa(self, v_or_vs) -> FrozenSet:
-        if isinstance(v_or_vs, str):
-            return self._pa[v_or_vs]
-        else:
-            return fzset_union(self._pa[v] for v in v_or_vs)
+        return self._names(self._union(self._pa_bits, self._mask(v_or_vs)))
 
 
     def ch(self, v_or_vs) -> FrozenSet:
-        if isinstance(v_or_vs, str):
-            return self._ch[v_or_vs]
-        else:
-            return fzset_union(self._ch[v] for v in v_or_vs)
+        return self._names(self._union(self._ch_bits, self._mask(v_or_vs)))
 
 
     def Ch(self, v_or_vs) -> FrozenSet:
@@ -161,65 +453,140 @@ class CausalDiagram:
 
 
     def An(self, v_or_vs) -> FrozenSet:
-        if isinstance(v_or_vs, str):
-            return self.__an(v_or_vs) | {v_or_vs}
         return self.an(v_or_vs) | wrap(v_or_vs, frozenset)
 
 
     def an(self, v_or_vs) -> FrozenSet:
-        if isinstance(v_or_vs, str):
-            return self.__an(v_or_vs)
-        return fzset_union(self.__an(v) for v in wrap(v_or_vs))
+        return self._names(self._an_mask(self._mask(v_or_vs)))
 
 
     def De(self, v_or_vs) -> FrozenSet:
-        if isinstance(v_or_vs, str):
-            return self.__de(v_or_vs) | {v_or_vs}
         return self.de(v_or_vs) | wrap(v_or_vs, frozenset)
 
 
     def de(self, v_or_vs) -> FrozenSet:
-        if isinstance(v_or_vs, str):
-            return self.__de(v_or_vs)
-        return fzset_union(self.__de(v) for v in wrap(v_or_vs))
-
-
-    def __an(self, v) -> FrozenSet:
-        if v in self._an:
-            return self._an[v]
-        self._an[v] = fzset_union(self.__an(parent) for parent in self._pa[v]) | self._pa[v]
-        return self._an[v]
-
-
-    def __de(self, v) -> FrozenSet:
-        if v in self._de:   
-            return self._de[v]
-        self._de[v] = fzset_union(self.__de(child) for child in self._ch[v]) | self._ch[v]
-        return self._de[v]
+        return self._names(self._de_mask(self._mask(v_or_vs)))
+
+
+    def _an_mask(self, mask: int) -> int:
+        out = 0
+        for i in bits(mask):
+            out |= self.__an(i)
+        return out
+
+
+    def _de_mask(self, mask: int) -> int:
+        out = 0
+        for i in bits(mask):
+            out |= self.__de(i)
+        return out
+
+
+    def __an(self, i) -> int:
+        if i in self._an_bits:
+            return self._an_bits[i]
+        return self.__closure(i, self._pa_bits, self._an_bits)
+
+
+    def __de(self, i) -> int:
+        if i in self._de_bits:   
+            return self._de_bits[i]
+        return self.__closure(i, self._ch_bits, self._de_bits)
+
+
+    @staticmethod
+    def __closure(i, adjacency: dict, cache: dict) -> int:
+        # 재귀 대신 explicit stack으로 cache를 채움 (긴 chain에서도 RecursionError 없음)
+        stack = [i]
+        while stack:
+            j = stack[-1]
+            if j in cache:
+                stack.pop()
+                continue
+            adj = adjacency[j]
+            pending = [k for k in bits(adj) if k not in cache]
+            if pending:
+                stack += pending
+                continue
+            stack.pop()
+            closure = adj
+            for k in bits(adj):
+                closure |= cache[k]
+            cache[j] = closure
+        return cache[i]
+
+
+    def precompute(self) -> 'CausalDiagram':
+        '''
+        Computes every ancestor/descendant set, the c-components and the causal order now (for many queries
+        against the same diagram); diagrams derived from it afterwards start from the restricted closure.
+        '''
+        self.__ensure_closure()
+        self._ccs()
+        self.causal_order()
+        return self
+
+
+    def __ensure_closure(self):
+        an, de = self._an_bits, self._de_bits
+        if an or de:
+            # 파생된 diagram: 바뀐 vertex만 cache에서 빠져 있으므로 그 부분만 다시 계산
+            for i in bits(self._v):
+                if i not in an:
+                    self.__closure(i, self._pa_bits, an)
+                if i not in de:
+                    self.__closure(i, self._ch_bits, de)
+            return
+
+        # ancestors는 위에서 아래로, descendants는 아래에서 위로 한 번씩 훑으면 됨
+        order = list(bits(self._v))     # index 순서가 곧 causal order
+        for i in order:
+            pa = self._pa_bits[i]
+            closure = pa
+            for k in bits(pa):
+                closure |= an[k]
+            an[i] = closure
+        for i in reversed(order):
+            ch = self._ch_bits[i]
+            closure = ch
+            for k in bits(ch):
+                closure |= de[k]
+            de[i] = closure
 
 
     def do(self, v_or_vs) -> 'CausalDiagram':
-        return self._do_(wrap(v_or_vs))
+        v_or_vs = wrap(v_or_vs)
+        return self.__derived(self._v, self._cut | self._mask(v_or_vs), v_or_vs, None)
 
 
-    def _do_(self, v_or_vs) -> 'CausalDiagram':
-        return CausalDiagram(None, None, None, self, wrap(v_or_vs))
+    def __derived(self, vertices: int, cut: int, with_do, with_induced) -> 'CausalDiagram':
+        if vertices == self._v and cut == self._cut:
+            return self
+        key = (self._index, vertices, cut)
+        G = DIAGRAM_CACHE.get(key)
+        if G is None:
+            G = CausalDiagram(None, None, None, copy=self, with_do=with_do, with_induced=with_induced)
+            DIAGRAM_CACHE.put(key, G)
+        return G
 
 
     def has_edge(self, x, y) -> bool:
-        return y in self._ch[x]
+        return bool(self.__adjacent(self._ch_bits, x) & self._mask(y))
 
 
     def is_confounded(self, x, y) -> bool:
-        return {x, y} in self.confounded_dict.values()
+        return bool(self.__adjacent(self._bi_bits, x) & self._mask(y))
 
 
     def u_of(self, x, y):
-        key = {x, y}
-        for u, ab in self.confounded_dict.items():
-            if ab == key:
-                return u
-        return None
+        if not self.is_confounded(x, y):
+            return None
+        return self._u_pairs[self.__pair(x, y)][0]
+
+
+    def __pair(self, x, y) -> Tuple[int, int]:
+        i, j = self._index.index[x], self._index.index[y]
+        return (i, j) if i < j else (j, i)
 
 
     def confounded_with(self, u):
@@ -227,7 +594,12 @@ class CausalDiagram:
 
 
     def confounded_withs(self, v):
-        return {next(iter(xy - {v})) for xy in self.confounded_dict.values() if v in xy}
+        return self._names(self.__adjacent(self._bi_bits, v))
+
+
+    def __adjacent(self, adjacency, v) -> int:
+        i = self._index.index.get(v)
+        return 0 if i is None or not self._v >> i & 1 else adjacency[i]
 
 
     def __getitem__(self, item) -> 'CausalDiagram':
@@ -235,9 +607,12 @@ class CausalDiagram:
 
 
     def induced(self, v_or_vs) -> 'CausalDiagram':
-        if set(v_or_vs) == self.V:
+        v_or_vs = wrap(v_or_vs)
+        if v_or_vs == self.V:
             return self
-        return CausalDiagram(None, None, None, copy=self, with_induced=v_or_vs)
+        assert v_or_vs <= self.V
+        s = self._index.mask(v_or_vs)
+        return self.__derived(s, self._cut & s, None, v_or_vs)
 
 
     @property
@@ -271,13 +646,24 @@ class CausalDiagram:
 
 
     def causal_order(self, backward=False) -> Tuple:
-        gg = nx.DiGraph(self.edges)
-        gg.add_nodes_from(self.V)
-        top_to_bottom = list(nx.topological_sort(gg))
+        # root의 causal order를 V로 제한한 것 (edge를 지우는 do()에서도 그대로 유효)
+        if self.__order is None:
+            names = self._index.names
+            self.__order = tuple(names[i] for i in bits(self._v))
         if backward:
-            return tuple(reversed(top_to_bottom))
+            return tuple(reversed(self.__order))
         else:
-            return tuple(top_to_bottom)
+            return self.__order
+
+
+    def position(self, v) -> int:
+        '''Position of v in the causal order of the root diagram, consistent with causal_order() of every derived diagram.'''
+        return self._index.index[v]
+
+
+    def preceding(self, v) -> FrozenSet:
+        '''Vertices of this diagram that come before v in causal_order().'''
+        return self._names(self._v & ((1 << self._index.index[v]) - 1))
 
 
     def __add__(self, edges):
@@ -289,62 +675,46 @@ class CausalDiagram:
         return CausalDiagram(self.V, set(self.edges) | directed_edges, self.confounded_to_3tuples() | bidirected_edges)
 
 
-    def __ensure_confoundeds_cached(self):
-        if self.__confoundeds is None:
-            self.__confoundeds = dict()
-            for u, (x, y) in self.confounded_dict.items():
-                if x not in self.__confoundeds:
-                    self.__confoundeds[x] = set()
-                if y not in self.__confoundeds:
-                    self.__confoundeds[y] = set()
-                self.__confoundeds[x].add(y)
-                self.__confoundeds[y].add(x)
-            self.__confoundeds = {x: frozenset(ys) for x, ys in self.__confoundeds.items()}
-            for v in self.V:
-                if v not in self.__confoundeds:
-                    self.__confoundeds[v] = frozenset()
-
-
-    def __ensure_cc_cached(self):
-        if self.__cc is None:
-            self.__ensure_confoundeds_cached()
-            ccs = []
-            remain = set(self.V)
-            found = set()
-            while remain:   
-                v = next(iter(remain))
-                a_cc = set()
-                to_expand = [v]
-                while to_expand:    # bidirected로 연결된 노드 모두 방문
-                    v = to_expand.pop()
-                    a_cc.add(v)
-                    to_expand += list(self.__confoundeds[v] - a_cc)
-                ccs.append(a_cc)    # CC list에 방금 구한 CC 추가
-                found |= a_cc
-                remain -= found
-            self.__cc2 = frozenset(frozenset(a_cc) for a_cc in ccs)
-            self.__cc_dict2 = {v: a_cc for a_cc in self.__cc2 for v in a_cc}
-
-            self.__cc = self.__cc2
-            self.__cc_dict = self.__cc_dict2
+    def _ccs(self) -> CComponents:
+        if self.__ccs is None:
+            if self.__ccs_from is None:
+                self.__ccs = CComponents.of(self._index, self._v, self._bi_bits)
+            else:
+                parent, vertices, touched = self.__ccs_from
+                self.__ccs = parent._ccs().restricted(vertices, self._bi_bits, touched)
+                self.__ccs_from = None
+        return self.__ccs
 
 
     @property
     def c_components(self) -> FrozenSet:
-        self.__ensure_cc_cached()
+        if self.__cc is None:
+            self.__cc = self._ccs().named
         return self.__cc
 
 
     def c_component(self, v_or_vs) -> FrozenSet:
         assert isinstance(v_or_vs, str)
-        self.__ensure_cc_cached()
+        if self.__cc_dict is None:
+            self.__cc_dict = {v: a_cc for a_cc in self.c_components for v in a_cc}
         return fzset_union(self.__cc_dict[v] for v in wrap(v_or_vs))
 
 
+
     def confounded_to_3tuples(self) -> FrozenSet[Tuple[str, str, str]]:
         return frozenset((*sorted([x, y]), u) for u, (x, y) in self.confounded_dict.items())
 
 
+    def __reduce__(self):
+        # 구조만 보냄 (vertex 이름, parent index, confounder), cache와 파생 정보는 받는 쪽에서 다시 계산
+        vs = list(bits(self._v))
+        local = {i: k for k, i in enumerate(vs)}
+        names = tuple(self._index.names[i] for i in vs)
+        parents = tuple(tuple(local[j] for j in bits(self._pa_bits[i])) for i in vs)
+        confounded = tuple((local[i], local[j], u) for i, j in self._bi_pairs() for u in self._u_pairs[i, j])
+        return _decoded, (names, parents, confounded)
+
+
     def __eq__(self, other):
         if not isinstance(other, CausalDiagram):
             return False
@@ -368,6 +738,64 @@ class CausalDiagram:
 
 
     def __str__(self):
+        return self.to_string()
+
+
+    def to_string(self, mode: str = 'chains') -> str:
+        '''
+        mode
+            'chains' : greedy chain cover of the directed and bidirected edges, O(V + E + U) (default)
+            'edges'  : plain edge lists, O(V + E + U)
+            'paths'  : longest directed paths and bidirected simple paths (exponential in the worst case)
+        '''
+        if mode == 'chains':
+            paths, bipaths = self.__chains(self._ch_bits, directed=True), self.__chains(self._bi_bits, directed=False)
+        elif mode == 'edges':
+            names = self._index.names
+            paths = [(names[i], names[j]) for i in bits(self._v) for j in bits(self._ch_bits[i])]
+            bipaths = [(names[i], names[j]) for i in bits(self._v) for j in bits(self._bi_bits[i]) if i < j]
+        elif mode == 'paths':
+            paths, bipaths = self.__paths()
+        else:
+            raise ValueError(f'unknown mode: {mode}')
+        return self.__format(paths, bipaths)
+
+
+    def __chains(self, adjacency: dict, directed: bool) -> list:
+        # causal order 순서로 남은 edge를 따라가며 chain을 만듦. edge 하나당 한 번만 봄
+        names = self._index.names
+        remain = {i: adjacency[i] for i in bits(self._v)}
+        chains = []
+        for i in bits(self._v):
+            while remain[i]:
+                chain, j = [names[i]], i
+                while remain[j]:
+                    k = (remain[j] & -remain[j]).bit_length() - 1
+                    remain[j] ^= 1 << k
+                    if not directed:
+                        remain[k] &= ~(1 << j)
+                    chain.append(names[k])
+                    j = k
+                chains.append(chain)
+        return chains
+
+
+    def __format(self, paths, bipaths) -> str:
+        # a -> b -> c
+        # e -> d -> c
+        # == a->b->c<-d<-e
+        paths_string = [' ⟶ '.join(path) for path in paths]
+        bipaths_string = [' ⟷ '.join(path) for path in bipaths]
+        alone = self.V - {x for path in paths for x in path} - {x for path in bipaths for x in path}
+        if alone:
+            return f'[{",".join([str(x) for x in alone])} / ' + (', '.join(paths_string) + ' / ' + ', '.join(bipaths_string)) + ']'
+        else:
+            return f'[' + (', '.join(paths_string) + ' / ' + ', '.join(bipaths_string)) + ']'
+
+
+    def __paths(self):
+        import networkx as nx
+
         nxG = nx.DiGraph(sortup(self.edges))
         paths = []
         while nxG.edges:
@@ -416,18 +844,12 @@ class CausalDiagram:
                 if modified:
                     break
 
-        # a -> b -> c
-        # e -> d -> c
-        # == a->b->c<-d<-e
-        paths_string = [' ⟶ '.join(path) for path in paths]
-        bipaths_string = [' ⟷ '.join(path) for path in bipaths]
-        alone = self.V - {x for path in paths for x in path} - {x for path in bipaths for x in path}
-        if alone:
-            return f'[{",".join([str(x) for x in alone])} / ' + (', '.join(paths_string) + ' / ' + ', '.join(bipaths_string)) + ']'
-        else:
-            return f'[' + (', '.join(paths_string) + ' / ' + ', '.join(bipaths_string)) + ']'
-    
+        return paths, bipaths
+
     def draw_graph(self):
+        # plotting 할 때만 networkx, matplotlib을 불러옴 (import 시간 절약)
+        import networkx as nx
+        import matplotlib.pyplot as plt
 
         # Create a directed graph
         G = nx.DiGraph()
@@ -457,10 +879,155 @@ class CausalDiagram:
 CD = CausalDiagram
 
 
+class GeneratedUNames:
+    '''
+    pair -> U names of a diagram built by CausalDiagram.from_arrays without explicit U names.
+    U{i}_{j} is generated on demand instead of materialising one entry per bidirected edge; it is built from the
+    positions of the pair in the causal order, not the vertex names, so that it is unique even for names with '_'.
+    '''
+    __slots__ = ('_bidirected',)
+
+    def __init__(self, bidirected: Tuple[int, ...]):
+        self._bidirected = bidirected
+
+
+    def __getitem__(self, pair: Tuple[int, int]) -> Tuple[str]:
+        i, j = pair
+        return (f'U{i}_{j}',)
+
+
+    def items(self):
+        for i, bi in enumerate(self._bidirected):
+            for j in bits(bi >> (i + 1)):
+                yield (i, i + 1 + j), self[i, i + 1 + j]
+
+
+def _stored_words(G: CausalDiagram) -> int:
+    '''
+    64-bit words a diagram holds: its adjacency rows as stored, plus the ancestor and descendant caches once
+    filled (an int per vertex each, on average half as wide as the highest vertex index).
+    '''
+    rows = sum((G._pa_bits[i].bit_length() >> 6) + (G._ch_bits[i].bit_length() >> 6) +
+               (G._bi_bits[i].bit_length() >> 6) + 3 for i in bits(G._v))
+    return rows + len(G.V) * ((G._v.bit_length() >> 6) + 1)
+
+
+def _decoded(names, parents, confounded) -> CausalDiagram:
+    '''CausalDiagram from its pickled encoding (names in causal order, parent positions, (i, j, U) confounders)'''
+    return CausalDiagram._decode(names, parents, confounded)
+
+
+def _nonzero(matrix):
+    import numpy as np
+
+    if hasattr(matrix, 'tocoo'):
+        coo = matrix.tocoo()
+        keep = coo.data != 0
+        return np.asarray(coo.row)[keep], np.asarray(coo.col)[keep]
+    return np.nonzero(np.asarray(matrix))
+
+
+def _edge_array(edges, n: int):
+    import numpy as np
+
+    if edges is None:
+        return np.empty((0, 2), dtype=np.int64)
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    assert edges.size == 0 or (edges.min() >= 0 and edges.max() < n), 'edge index out of range'
+    return edges
+
+
+def _array_topological_order(parents, children, names):
+    '''
+    Kahn's algorithm over the edge arrays; like topological_sort, the available vertex with the smallest name goes first,
+    so from_arrays and the constructor give the same order for the same graph.
+    '''
+    import numpy as np
+
+    n = len(names)
+    # 이름 순서의 rank로 heap을 돌림
+    by_name = np.argsort(names, kind='stable')
+    rank = np.empty(n, dtype=np.int64)
+    rank[by_name] = np.arange(n)
+    by_parent = np.argsort(rank[parents], kind='stable')
+    targets = rank[children[by_parent]].tolist()
+    starts = np.concatenate([[0], np.cumsum(np.bincount(rank[parents], minlength=n))]).tolist()
+    indegree = np.bincount(rank[children], minlength=n).tolist()
+
+    frontier = [r for r in range(n) if not indegree[r]]
+    order = []
+    while frontier:
+        r = heapq.heappop(frontier)
+        order.append(r)
+        for c in targets[starts[r]:starts[r + 1]]:
+            indegree[c] -= 1
+            if not indegree[c]:
+                heapq.heappush(frontier, c)
+    assert len(order) == n, 'directed edges must form a DAG'
+    return by_name[order]
+
+
+def _bitmask_rows(rows, cols, n: int, block: int = 1024) -> Tuple[int, ...]:
+    '''int bitmask of cols for every row, assembled from 64-bit words block by block.'''
+    import numpy as np
+
+    words = -(-n // 64)
+    # (row, word) 별로 bit를 OR해서 모음
+    keys = rows.astype(np.int64) * words + (cols >> 6)
+    by_key = np.argsort(keys, kind='stable')
+    keys, values = keys[by_key], np.left_shift(np.uint64(1), (cols[by_key] & 63).astype(np.uint64))
+    starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]])) if len(keys) else np.empty(0, dtype=np.int64)
+    keys, values = keys[starts], np.bitwise_or.reduceat(values, starts) if len(keys) else values
+    bounds = np.searchsorted(keys, np.arange(0, n + block, block) * words)
+    # row마다 마지막 nonzero word까지만 int로 변환
+    ends = np.searchsorted(keys, (np.arange(n) + 1) * words)
+    nonempty = ends > np.searchsorted(keys, np.arange(n) * words)
+    lengths = np.zeros(n, dtype=np.int64)
+    lengths[nonempty] = (keys[ends[nonempty] - 1] % words + 1) * 8
+
+    masks = []
+    for b, start in enumerate(range(0, n, block)):
+        stop = min(start + block, n)
+        dense = np.zeros((stop - start) * words, dtype='<u8')
+        dense[keys[bounds[b]:bounds[b + 1]] - start * words] = values[bounds[b]:bounds[b + 1]]
+        row_bytes = memoryview(dense).cast('B')
+        width = words * 8
+        masks.extend(int.from_bytes(row_bytes[k * width:k * width + length], 'little') if length else 0
+                     for k, length in enumerate(lengths[start:stop].tolist()))
+    return tuple(masks)
+
+
+def topological_sort(vs: Iterable[str], directed_edges: Iterable[Tuple[str, str]]) -> Tuple[str, ...]:
+    '''Kahn's algorithm; ties are broken by name so that the order is deterministic.'''
+    vs = set(vs)
+    children = pairs2dict(directed_edges)
+    indegree = dict.fromkeys(vs, 0)
+    for v in vs:
+        for c in children[v]:
+            indegree[c] += 1
+    frontier = [v for v, d in indegree.items() if d == 0]
+    heapq.heapify(frontier)
+    order = []
+    while frontier:
+        v = heapq.heappop(frontier)
+        order.append(v)
+        for c in children[v]:
+            indegree[c] -= 1
+            if not indegree[c]:
+                heapq.heappush(frontier, c)
+    assert len(order) == len(vs), 'directed edges must form a DAG'
+    return tuple(order)
+
+
 if __name__ == "__main__":
     G = CausalDiagram({'X', 'Z', 'Y'}, 
                     [('X', 'Z'), ('Z', 'Y')],
                     [])
     
     print(G)
-    print(G.c_components())
\ No newline at end of file
+    print(G.c_components)
+
+    # pickle round trip keeps the causal order (derived diagram whose order differs from sorting it again)
+    import pickle
+    H = CausalDiagram(['B', 'Z', 'A'], [('Z', 'A')], [])[{'A', 'B'}]
+    assert pickle.loads(pickle.dumps(H)).causal_order() == H.causal_order() == ('B', 'A')
\ No newline at end of file
@@ -1,33 +1,87 @@
 import re
-import copy
-from itertools import permutations
+import threading
+import weakref
+from collections import Counter, defaultdict
+
+_EMPTY = frozenset()
+
+# simplify에서 적용된 rewrite 횟수 (rule 이름 -> 횟수). REWRITE_COUNTS.clear()로 초기화
+REWRITE_COUNTS = Counter()
+
+
+def _frozen(vs) -> frozenset:
+    '''frozenset without copying frozensets, sharing one empty set between all nodes'''
+    if isinstance(vs, frozenset):
+        return vs if vs else _EMPTY
+    return frozenset(vs) if vs else _EMPTY
 
 # Define a probability distribution class
 class Probability:
     '''
     condition은 get_new_probability로 우선 fraction 형태로 처리되고 가능한 경우 simplify에서 _var|_cond 로 변경됨
+
+    Expressions are immutable and hash-consed: structurally equal nodes are a single object, so
+    copy() is free and replace() / simplify() build new nodes that share the rest of the tree.
     '''
+    __slots__ = ('_var', '_cond', '_do', '_recursive', '_children', '_sumset', '_fraction', '_divisor', '_scope',
+                 '_free', '_simplified', '__weakref__')
 
-    def __init__(self, var=set(), cond=set(), do=set(), recursive=False, children=set(), sumset=set(), fraction=False,
-                 divisor=None, scope: set = set()):
-        self._var = var                     # Random variables
-        self._cond = cond                   # Conditions
-        self._do = do                       # Do operator
-        self._recursive = recursive         # Recursive flag
-        self._children = children           # Set of children
-        self._sumset = sumset               # Summation set
-        self._fraction = fraction           # Fraction flag
-        self._divisor = divisor             # Divisor
+    # (var, cond, do, recursive, children, sumset, fraction, divisor, scope) -> node
+    _interned = weakref.WeakValueDictionary()
+    _interning = threading.Lock()     # 여러 thread에서 같은 node가 두 번 만들어지지 않도록
 
+    def __new__(cls, var=set(), cond=set(), do=set(), recursive=False, children=set(), sumset=set(), fraction=False,
+                divisor=None, scope: set = set()):
+        var, cond = _frozen(var), _frozen(cond)
         # 기본적으로 scope를 var과 cond로 설정        
         if not scope:
-            scope = self._var | self._cond
-        self._scope = scope
+            scope = var | cond
+        return cls._make(var, cond, do, recursive, children, sumset, fraction, divisor, scope)
+
+
+    @classmethod
+    def _make(cls, var, cond, do, recursive, children, sumset, fraction, divisor, scope) -> 'Probability':
+        key = (_frozen(var),                # Random variables
+               _frozen(cond),               # Conditions
+               _frozen(do),                 # Do operator
+               bool(recursive),             # Recursive flag
+               _frozen(children),           # Set of children
+               _frozen(sumset),             # Summation set
+               bool(fraction),              # Fraction flag
+               divisor,                     # Divisor
+               _frozen(scope))
+        with cls._interning:
+            node = cls._interned.get(key)
+            if node is None:
+                node = object.__new__(cls)
+                for name, value in zip(cls.__slots__, key):
+                    object.__setattr__(node, name, value)
+                object.__setattr__(node, '_free', None)
+                object.__setattr__(node, '_simplified', None)
+                cls._interned[key] = node
+        return node
+
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"Probability is immutable, use replace({name.lstrip('_')}=...)")
+
+
+    def __reduce__(self):
+        return Probability._make, (self._var, self._cond, self._do, self._recursive, self._children, self._sumset,
+                                   self._fraction, self._divisor, self._scope)
+
+
+    def replace(self, **changes) -> 'Probability':
+        '''Node with some of var, cond, do, recursive, children, sumset, fraction, divisor, scope changed (scope is kept as it is).'''
+        fields = {'var': self._var, 'cond': self._cond, 'do': self._do, 'recursive': self._recursive,
+                  'children': self._children, 'sumset': self._sumset, 'fraction': self._fraction,
+                  'divisor': self._divisor, 'scope': self._scope}
+        fields.update(changes)
+        return Probability._make(**fields)
 
 
     def copy(self):
-        new_P = copy.deepcopy(self)
-        return new_P
+        return self
 
 
     @property
@@ -60,7 +114,12 @@ class Probability:
     def getFreeVariables(self) -> set:
         '''Function that returns the free variables of the distribution.'''
         # Probability가 정의된 random variables return : (vars - sumset) & scope
+        if self._free is None:
+            object.__setattr__(self, '_free', frozenset(self.__free_variables()))
+        return self._free
+
 
+    def __free_variables(self) -> set:
         free = set()
         
         if not self._recursive:
@@ -82,97 +141,75 @@ class Probability:
         return free
     
 
-    def simplify(self):
+    def simplify(self) -> 'Probability':
+        '''Returns the simplified expression (nodes are immutable, so the result is cached on the node).'''
+        if self._simplified is None:
+            object.__setattr__(self, '_simplified', self.__simplify())
+        return self._simplified
+
+
+    def __simplify(self) -> 'Probability':
 
         # for loop 돌면서 children 만드는 경우 children이 1개면 불필요하게 nested 됨
         # 밖으로 꺼내주고 이미 get_new_probability에서 simplify해서 추가적인 정리 필요 없음        
         if self._recursive and len(self._children)==1:
-            child = next(iter(self._children))
-            self.__dict__ = child.__dict__      # child의 정보를 self에 복사
-            return
-        
+            REWRITE_COUNTS['collapse'] += 1
+            return next(iter(self._children))
+
+        var, cond, sumset, children = self._var, self._cond, self._sumset, self._children
+        recursive, fraction, divisor = self._recursive, self._fraction, self._divisor
+
         # get_new_probability에서 simplify 를 해서 안해도 될 것 같음
-        if self._divisor:
-            self._divisor.simplify()
-        
+        if divisor:
+            divisor = divisor.simplify()
+
+        # children이 있는 경우 child끼리 합치고(chain rule) sumset 변수를 지움(sum-out)
+        if recursive:
+            children, sumset = _ProductRewriter(children, sumset).run()
+            return self.replace(sumset=sumset, children=children, divisor=divisor)
+
         # 한번이라도 simplify가 되었다면 다시 탐색
-        # self._sumset, self._recursive, self._fraction 의 유무에 따라 simplify 방법 달라짐
+        # sumset, fraction 의 유무에 따라 simplify 방법 달라짐
         flag = True 
         while flag:
             flag = False
             
-            # sumset도 없고, children도 없고, fraction도 없다면
-            if not self._sumset and not self._recursive and not self._fraction:
-                return 
+            # sumset도 없고, fraction도 없다면
+            if not sumset and not fraction:
+                break
 
-            # sumset이 있는데, children이 없고, fraction도 없다면
+            # sumset이 있는데, fraction은 없다면
             # sum_c P(a, c) = P(a)
-            elif self._sumset and not self._recursive and not self._fraction:
-                sum_variables = self._sumset & self._var
-                self._sumset = self._sumset - sum_variables
-                self._var = self._var - sum_variables
-                flag = True
-
-            # children있으면서, fraction 있는 경우
-            elif not self._recursive and self._fraction:
+            elif sumset and not fraction:
+                sum_variables = sumset & var
+                sumset = sumset - sum_variables
+                var = var - sum_variables
+                if sum_variables:
+                    REWRITE_COUNTS['marginal'] += 1
+                    flag = True
+
+            # fraction 있는 경우
+            else:
                 
                 # P(x, y) / P() = P(x, y)
-                if not self._divisor._var:
-                    self._divisor = None
-                    self._fraction = False
+                if not divisor._var:
+                    divisor = None
+                    fraction = False
+                    REWRITE_COUNTS['unit divisor'] += 1
                     flag = True
 
 
                 # 만약 분모의 condition이 없고 divisor의 V가 분자 V의 부분집합이면 분모 제거
                 # P(x, y) / P(y) = P(x|y)
-                elif not self._divisor._cond and self._divisor._var<=self._var:
-                    self._var = self._var - self._divisor._var
-                    self._cond = self._cond | self._divisor._var
-                    self._divisor = None
-                    self._fraction = False
+                elif not divisor._cond and divisor._var<=var:
+                    var = var - divisor._var
+                    cond = cond | divisor._var
+                    divisor = None
+                    fraction = False
+                    REWRITE_COUNTS['conditional'] += 1
                     flag = True
-            
-            # children이 있는 경우 child끼리 합칠 수 있는지 확인
-            elif self._recursive:
-                
-                for prob1, prob2 in permutations(self._children, 2):
-                    
-                    # 모두 children이 없다면
-                    if not prob1._recursive and not prob2._recursive:
-                        
-                        # P(Y|X,Z)P(X|Z) = P(Y,X|Z), P(Y|X)P(X) = P(Y,X)
-                        if prob1._cond == prob2._var | prob2._cond:
-                            removable = prob2
-                            prob1._var = prob1._var | prob2._var
-                            prob1._cond = prob1._cond - prob2._var
-                            self._children -= {removable}   # 합쳐져서 없어진 것 제거 (prob2)
-                            
-                            # # 만약 children이 하나가 남으면 recursive False로 하고 올려줌
-                            # if len(self._children) == 1:
-                            #     prob = next(iter(self._children))
-                            #     self.__dict__ = prob.__dict__
-
-                            flag = True      # 또 다른 simplify를 위해서 while문 돌아야 함
-
-                    if flag:  # 일단 하나 simplify 했으면 넘어감
-                        break
-                
-            # sum_c P(a, c|x, y, z) P(x | a, y)  = P(a | x, y, z) P(x | a, y)
-            # 대신 모든 children이 recursive가 없어야 함. 있는 경우 그 안에 self.sumset에 해당하는 변수가 있을 수 있어 함부로 지울 수 없음
-            if self._sumset and self._recursive and not any(child._recursive for child in self._children):
-                vars, conds = set(), set()
-                for child in self._children:
-                    vars |= child._var
-                    conds |= child._cond
-                
-                for child in self._children:
-                    if removable := (child._var - conds) & self._sumset:
-                        child._var  -= removable
-                        self._sumset -= removable
-                        if not child._var:
-                            self._children -= {child}
-                        flag = True
-                        break
+
+        return self.replace(var=var, cond=cond, sumset=sumset, fraction=fraction, divisor=divisor)
 
 
     def __lt__(self, other):
@@ -252,29 +289,127 @@ class Probability:
         return out
 
 
+class _ProductRewriter:
+    '''
+    Worklist rewrite engine for the factors of a product.
+    Non-recursive factors are indexed by their signature (var | cond) and by their cond, so that
+
+        chain rule : P(Y|X,Z)P(X|Z) = P(Y,X|Z)        (prob1._cond == prob2._var | prob2._cond)
+        sum-out    : sum_c P(a, c|x) P(x|a) = P(a|x)   (c in sumset, in no factor's cond or do; only without recursive factors)
+
+    are hash lookups, and only the factors touched by a rewrite go back on the worklist.
+    Factors are visited and partners chosen in a canonical order (not the hash order of the sets), so the same
+    product always simplifies to the same node.
+    '''
+
+    def __init__(self, children, sumset):
+        self.children = set()
+        self.sumset = sumset
+        self.sum_out = not any(child._recursive for child in children)
+        self.by_signature = defaultdict(set)    # var | cond -> factors
+        self.by_cond = defaultdict(set)         # cond -> factors
+        self.by_var = defaultdict(set)          # variable -> factors with it in var
+        self.cond_count = Counter()             # variable -> number of factors conditioning on it (cond or do)
+        for child in children:
+            self.add(child)
+
+
+    def add(self, prob):
+        if prob in self.children:
+            return
+        self.children.add(prob)
+        self.cond_count.update(prob._cond | prob._do)
+        if not prob._recursive:
+            self.by_signature[prob._var | prob._cond].add(prob)
+            self.by_cond[prob._cond].add(prob)
+            for v in prob._var:
+                self.by_var[v].add(prob)
+
+
+    def remove(self, prob) -> set:
+        '''removes prob and returns the variables that no factor conditions on anymore'''
+        self.children.remove(prob)
+        self.cond_count.subtract(prob._cond | prob._do)
+        if not prob._recursive:
+            self.by_signature[prob._var | prob._cond].discard(prob)
+            self.by_cond[prob._cond].discard(prob)
+            for v in prob._var:
+                self.by_var[v].discard(prob)
+        return {v for v in prob._cond | prob._do if not self.cond_count[v]}
+
+
+    @staticmethod
+    def canonical(prob) -> tuple:
+        return sorted(prob._var), sorted(prob._cond), sorted(prob._do), sorted(prob._sumset), prob._fraction
+
+
+    def sorted(self, probs) -> list:
+        # 뒤에서부터 꺼내므로 canonical order의 역순
+        return sorted(probs, key=self.canonical, reverse=True)
+
+
+    def partner(self, candidates, prob):
+        others = [other for other in candidates or () if other is not prob]
+        return min(others, key=self.canonical) if others else None
+
+
+    def run(self):
+        worklist = self.sorted(child for child in self.children if not child._recursive)
+        while worklist:
+            prob = worklist.pop()
+            if prob not in self.children:
+                continue
+
+            # P(Y|X,Z)P(X|Z) = P(Y,X|Z), P(Y|X)P(X) = P(Y,X) : prob가 앞쪽이거나 뒤쪽인 경우
+            if (other := self.partner(self.by_signature.get(prob._cond), prob)) is not None:
+                self.merge(prob, other, worklist)
+            elif (other := self.partner(self.by_cond.get(prob._var | prob._cond), prob)) is not None:
+                self.merge(other, prob, worklist)
+
+            # sum_c P(a, c|x, y, z) P(x | a, y)  = P(a | x, y, z) P(x | a, y)
+            # 대신 모든 children이 recursive가 없어야 함. 있는 경우 그 안에 sumset에 해당하는 변수가 있을 수 있어 함부로 지울 수 없음
+            elif self.sum_out and (removable := {v for v in prob._var & self.sumset if not self.cond_count[v]}):
+                REWRITE_COUNTS['sum-out'] += 1
+                reduced = prob.replace(var=prob._var - removable)
+                self.sumset = self.sumset - removable
+                freed = self.remove(prob)
+                if reduced._var:
+                    self.add(reduced)
+                    worklist.append(reduced)
+                self.requeue(freed, worklist)
+
+        return frozenset(self.children), self.sumset
+
+
+    def merge(self, prob1, prob2, worklist):
+        REWRITE_COUNTS['chain'] += 1
+        merged = prob1.replace(var=prob1._var | prob2._var, cond=prob1._cond - prob2._var)
+        freed = self.remove(prob1) | self.remove(prob2)
+        self.add(merged)
+        worklist.append(merged)
+        self.requeue(freed, worklist)
+
+
+    def requeue(self, variables, worklist):
+        # cond에서 빠진 변수는 새로 sum-out 될 수 있음
+        if self.sum_out:
+            for v in sorted(variables & self.sumset):
+                worklist.extend(self.sorted(self.by_var[v]))
+
+
 def get_new_probability(P, var, cond={}):
     '''
     ID 알고리즘 line 6, 7에서 cond에는 있지만 S'에 속하지 않는 변수는 Freevariables에서 제거해야 함
     '''
 
-    P_out = P.copy()
-
     if len(cond) == 0:
-        P_out._sumset = P_out._sumset | (P.getFreeVariables() - var)
-        P_out.simplify()
+        P_out = P.replace(sumset=P._sumset | (P.getFreeVariables() - var)).simplify()
     else:
-        P_denom = P.copy()
-        P_out._sumset = P_out._sumset | (P.getFreeVariables() - (cond | var))
-        P_out.simplify()    # 분자 simplify
-        
-        P_out._fraction = True
-        P_denom._sumset = P_denom._sumset | (P.getFreeVariables()- cond)
-        P_denom.simplify()  # 분모 simplify
-        P_out._divisor = P_denom
-
-    P_out.simplify()
+        P_out = P.replace(sumset=P._sumset | (P.getFreeVariables() - (cond | var))).simplify()     # 분자 simplify
+        P_denom = P.replace(sumset=P._sumset | (P.getFreeVariables() - cond)).simplify()          # 분모 simplify
+        P_out = P_out.replace(fraction=True, divisor=P_denom)
 
-    return P_out
+    return P_out.simplify()
 
 if __name__ == "__main__":
     pass
\ No newline at end of file
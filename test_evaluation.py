@@ -0,0 +1,66 @@
+import numpy as np
+
+import evaluation
+from estimation import SampleSource, estimate
+from evaluation import Factor, SparseFactor, interventional
+from identification import myID
+from model import CD
+
+
+def test_sparse_product_without_shared_variables():
+    a, b = Factor(['A'], [0., 1., 2.]), Factor(['B'], [3., 0., 5., 1.])
+    out = a.sparse() * b.sparse()
+    assert out.vars == ('A', 'B')
+    assert np.allclose(out.table('A', 'B'), np.outer(a.values, b.values))
+
+
+def test_sparse_product_with_scalar():
+    a, c = Factor(['A'], [0., 1., 2.]), Factor((), 2.0)
+    assert np.allclose((a.sparse() * c.sparse()).table('A'), [0., 2., 4.])
+    assert np.allclose((c.sparse() * a.sparse()).table('A'), [0., 2., 4.])
+    assert np.allclose(Factor((), 0.0).sparse().dense().values, 0.)
+
+
+def test_estimate_product_of_disjoint_factors():
+    # P(a, b) P(y | x): 두 factor가 변수를 공유하지 않음
+    G = CD(['X', 'Y', 'A', 'B'], [('X', 'Y'), ('A', 'B')], [])
+    P = myID({'Y', 'A', 'B'}, {'X'}, G)
+    rng = np.random.default_rng(0)
+    data = {v: rng.integers(0, 200, 2000) for v in 'XYAB'}
+    value = estimate(P, data)
+    assert set(value.vars) == {'X', 'Y', 'A', 'B'}
+    # 관측된 x마다 y, a, b에 대한 합이 1
+    totals = value.sum_to({'X'}).table('X')
+    observed = np.unique(data['X'])
+    assert np.allclose(totals[observed], 1.)
+
+
+def test_sparse_matches_dense(monkeypatch):
+    G = CD(['X', 'Y', 'A', 'B'], [('X', 'Y'), ('A', 'B'), ('A', 'Y')], [])
+    P = myID({'Y', 'B'}, {'X'}, G)
+    rng = np.random.default_rng(1)
+    data = {v: rng.integers(0, 6, 500) for v in 'XYAB'}
+    dense = estimate(P, data)
+    # 모든 factor를 SparseFactor로 계산
+    monkeypatch.setattr(evaluation, 'SPARSE_MIN', 0)
+    monkeypatch.setattr(evaluation, 'DENSITY', 2.0)
+    sparse = estimate(P, data)
+    assert isinstance(dense, Factor) and isinstance(sparse, SparseFactor)
+    assert np.allclose(sparse.table(*dense.vars), dense.values)
+
+
+def test_interventional_averages_line3_variables():
+    # W -> X -> Y, W <-> X: P(y | w, x)에서 W는 ID line 3으로 남은 변수
+    G = CD(['W', 'X', 'Y'], [('W', 'X'), ('X', 'Y')], [('W', 'X', 'U')])
+    P = myID({'Y'}, {'X'}, G)
+    rng = np.random.default_rng(2)
+    n = 4000
+    u = rng.integers(0, 2, n)
+    w = (rng.random(n) < 0.2 + 0.6 * u).astype(int) + rng.integers(0, 2, n)
+    x = (rng.random(n) < 0.1 + 0.3 * u + 0.1 * w).astype(int)
+    y = np.minimum(x * 2 + (rng.random(n) < 0.3), 2) * (rng.random(n) < 0.9)
+    table = interventional(P, {'Y'}, {'X'}, SampleSource({'W': w, 'X': x, 'Y': y}))
+    assert table.shape == (2, 3)
+    assert np.allclose(table.sum(axis=1), 1.)
+    truth = np.array([[np.mean(y[x == k] == v) for v in range(3)] for k in range(2)])
+    assert np.abs(table - truth).max() < 0.05
@@ -1,10 +1,10 @@
 from itertools import combinations as itercomb, chain
 
-import numpy as np
 import os
-from collections import defaultdict
+import threading
+from collections import defaultdict, OrderedDict, namedtuple
 from contextlib import contextmanager
-from typing import Dict, Iterable, TypeVar, Generator, Tuple, Set, List, FrozenSet, AbstractSet
+from typing import Callable, Dict, Iterable, Optional, TypeVar, Generator, Tuple, Set, List, FrozenSet, AbstractSet
 
 T = TypeVar('T')
 
@@ -48,6 +48,7 @@ def dict_or(d1: dict, d2: dict) -> dict:
 
 def random_seeds(n=None):
     """Random seeds of given size or a random seed if n is None"""
+    import numpy as np
     if n is None:
         return np.random.randint(np.iinfo(np.int32).max)
     else:
@@ -62,10 +63,12 @@ def subseq(xs, indices):
 
 
 def pick_randomly(xs):
+    import numpy as np
     return xs[np.random.randint(len(xs))]
 
 
 def rand_argmax(xs):
+    import numpy as np
     max_val = np.nanmax(xs)
     if max_val is np.nan:
         return pick_randomly(np.arange(len(xs)))
@@ -91,6 +94,7 @@ def disjoint(set1: Set, set2: Set) -> bool:
 
 
 def rand_bw(lower, upper, precision=None):
+    import numpy as np
     assert lower <= upper
     if lower == upper:
         return lower
@@ -102,6 +106,7 @@ def rand_bw(lower, upper, precision=None):
 
 @contextmanager
 def seeded(seed=None):
+    import numpy as np
     if seed is not None:
         st0 = np.random.get_state()
         np.random.seed(seed)
@@ -126,6 +131,14 @@ def fzset_union(sets) -> FrozenSet:
     return frozenset(chain(*sets))
 
 
+def bits(mask: int) -> Generator[int, None, None]:
+    """ indices of the set bits of mask in increasing order """
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
 def sortup(xs: Iterable[T]) -> Tuple[T, ...]:
     return tuple(sorted(xs))
 
@@ -135,6 +148,7 @@ def sortup2(xxs):
 
 
 def shuffled(xs: Iterable[T]) -> List[T]:
+    import numpy as np
     xs = list(xs)
     np.random.shuffle(xs)
     return xs
@@ -155,5 +169,83 @@ def ors(values):
     return x
 
 
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'evictions', 'currsize', 'weight', 'maxsize', 'maxweight'])
+
+
+class LRUCache:
+    """
+    Bounded mapping with least-recently-used eviction and hit/miss counters.
+    Entries are evicted when there are more than maxsize of them, or when the total weight
+    (weigher(value) summed over the entries) exceeds maxweight. None disables a bound.
+    Safe to share between threads.
+    """
+
+    def __init__(self, maxsize: Optional[int] = 1024, maxweight: Optional[int] = None,
+                 weigher: Optional[Callable] = None):
+        self.maxsize = maxsize
+        self.maxweight = maxweight
+        self.weigher = weigher
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.weight = 0
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+            self._data[key] = value
+            if self.weigher is not None:
+                self.weight += self.weigher(value)
+            self._evict()
+
+    def resize(self, maxsize: Optional[int] = None, maxweight: Optional[int] = None):
+        with self._lock:
+            self.maxsize = maxsize
+            self.maxweight = maxweight
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.weight = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def info(self) -> CacheInfo:
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.evictions, len(self._data), self.weight, self.maxsize, self.maxweight)
+
+    def _pop(self, key):
+        value = self._data.pop(key)
+        if self.weigher is not None:
+            self.weight -= self.weigher(value)
+        return value
+
+    def _evict(self):
+        while self._data and ((self.maxsize is not None and len(self._data) > self.maxsize) or
+                              (self.maxweight is not None and self.weight > self.maxweight)):
+            self._pop(next(iter(self._data)))
+            self.evictions += 1
+
+
 def mkdirs(newdir):
     os.makedirs(newdir, mode=0o777, exist_ok=True)